@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from shiny import ui
+
+
+# browser side charting, loaded by the first chart a page shows (pages that
+# never switch to it do not fetch them) and each chart only ships its
+# aggregated rows as a Vega-Lite spec
+VEGA_SCRIPTS = [
+    "https://cdn.jsdelivr.net/npm/vega@5",
+    "https://cdn.jsdelivr.net/npm/vega-lite@5",
+    "https://cdn.jsdelivr.net/npm/vega-embed@6",
+]
+# largest number of fill levels drawn, the remaining ones are summed into OTHER_LABEL
+PLOT_TOP_N = int(os.environ.get('PLOT_TOP_N', 15))
+OTHER_LABEL = 'Other'
+# plots switch to a coarser time resolution once the finer one would draw
+# more bars than this
+PLOT_MAX_BARS = int(os.environ.get('PLOT_MAX_BARS', 120))
+# time resolutions the data is aggregated at, finest first, with the
+# (approximate) days per bar
+RESOLUTIONS = [('day', 1), ('week', 7), ('month', 30.4)]
+RESOLUTION_TITLES = {'day': 'Daily', 'week': 'Weekly', 'month': 'Monthly'}
+
+
+def pick_resolution(startD, endD, finest='day', max_bars=PLOT_MAX_BARS):
+    # finest resolution, starting at finest, that draws at most max_bars bars
+    # for the date range, the coarsest one when none of them does
+    days = (pd.Timestamp(endD) - pd.Timestamp(startD)).days
+    names = [name for name, _ in RESOLUTIONS]
+    candidates = RESOLUTIONS[names.index(finest):]
+    for name, days_per_bar in candidates:
+        if days / days_per_bar <= max_bars:
+            return name
+    return candidates[-1][0]
+
+
+def top_n_with_other(df, fill, value, by=('timestamp',), sums=None, n=PLOT_TOP_N):
+    # sums per (by, fill) where only the n fill values with the largest total
+    # value are kept and the rest are folded into one OTHER_LABEL level
+    sums = list(sums or [value])
+    fill_values = df[fill].astype('category')
+    totals = df[value].groupby(fill_values, observed=True).sum().sort_values(ascending=False)
+    top = totals.index[:n]
+    categories = [str(k) for k in top] + ([OTHER_LABEL] if len(totals) > n else [])
+    # old category code -> position in top, everything else -> OTHER_LABEL
+    remap = np.full(len(fill_values.cat.categories) + 1, len(top))
+    remap[fill_values.cat.categories.get_indexer(top)] = np.arange(len(top))
+    remap[-1] = -1
+    folded = pd.Categorical.from_codes(remap[fill_values.cat.codes.values], categories=categories)
+    return df[list(by) + sums].assign(**{fill: folded}) \
+        .groupby(by=list(by) + [fill], observed=True).sum().reset_index()
+
+
+def stacked_bar_spec(df, x, y, fill, facet=None, alpha=None, title='',
+                     x_title=None, y_title=None, width=700, height=200):
+    # Vega-Lite spec for stacked bars of y per x and fill, optionally one row
+    # per facet value (independent y scales) and alpha as the bar opacity.
+    # Rows are summed per (x, fill, facet) before they are serialized.
+    keys = [x, fill] + ([facet] if facet else [])
+    values = [y] + ([alpha] if alpha else [])
+    agg = df[keys + values].groupby(by=keys, observed=True).sum().reset_index()
+    agg[x] = agg[x].dt.strftime('%Y-%m-%d')
+    agg[y] = agg[y].round(2)
+    for column in keys[1:]:
+        agg[column] = agg[column].astype(str)
+
+    encoding = {
+        'x': {'field': x, 'type': 'temporal', 'timeUnit': 'yearmonthdate',
+              'title': x_title or x},
+        'y': {'field': y, 'type': 'quantitative', 'aggregate': 'sum',
+              'title': y_title or y},
+        'color': {'field': fill, 'type': 'nominal'},
+        'tooltip': [{'field': c, 'type': 'nominal'} for c in keys[1:]] + [
+            {'field': x, 'type': 'temporal'},
+            {'field': y, 'type': 'quantitative', 'format': ',.2f'}],
+    }
+    if alpha:
+        encoding['opacity'] = {'field': alpha, 'type': 'quantitative',
+                               'aggregate': 'sum', 'scale': {'range': [0.2, 1]}}
+    spec = {
+        '$schema': 'https://vega.github.io/schema/vega-lite/v5.json',
+        'title': title,
+        'data': {'values': agg.to_dict(orient='records')},
+    }
+    chart = {'mark': {'type': 'bar'}, 'encoding': encoding,
+             'width': width, 'height': height}
+    if facet:
+        spec.update({
+            'facet': {'row': {'field': facet, 'type': 'nominal'}},
+            'spec': chart,
+            'resolve': {'scale': {'y': 'independent'}},
+        })
+    else:
+        spec.update(chart)
+    return spec
+
+
+# loads VEGA_SCRIPTS in order, once per page, into the window.vegaReady promise
+VEGA_LOADER = """
+window.vegaReady = window.vegaReady || %s.reduce(function(ready, src) {
+  return ready.then(function() {
+    return new Promise(function(resolve, reject) {
+      var script = document.createElement('script');
+      script.src = src;
+      script.onload = resolve;
+      script.onerror = reject;
+      document.head.appendChild(script);
+    });
+  });
+}, Promise.resolve());
+"""
+
+
+def script_json(value):
+    # JSON that is safe inside an inline <script>, '</' would end the tag
+    return json.dumps(value).replace('</', '<\\/')
+
+
+def chart_ui(id, spec):
+    # container plus the inline script that draws the spec into it
+    return ui.TagList(
+        ui.div(id=id, style="width: 100%;"),
+        ui.tags.script(
+            VEGA_LOADER % script_json(VEGA_SCRIPTS) +
+            f"window.vegaReady.then(function() {{ vegaEmbed('#{id}', {script_json(spec)}, {{actions: false}}); }});"),
+    )
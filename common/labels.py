@@ -0,0 +1,48 @@
+import pandas as pd
+from shiny import ui
+
+
+# rendered checkbox labels, memoized per (category value, badge values) tuple
+LABEL_CACHE_SIZE = 20000
+# longest checkbox list sent to the browser, the rest is reachable through the filters
+MAX_CHOICES = 200
+
+_label_cache = {}
+
+
+def render_labels(names: pd.Series, badges) -> list:
+    # badges is a list of (html template, values) pairs, e.g.
+    # ('<span class="badge alert-info">{:,} PB</span>', sizes). Only labels that
+    # are not cached yet are formatted, with column-wise string concatenation.
+    names = names.reset_index(drop=True)
+    badge_values = [values.reset_index(drop=True) for _, values in badges]
+    keys = list(zip(names, *badge_values))
+    missing = [i for i, key in enumerate(keys) if key not in _label_cache]
+    if missing:
+        html = '<span> <span class="category-name">' + names[missing].astype(str) + '</span> '
+        for (template, _), values in zip(badges, badge_values):
+            html = html + values[missing].map(template.format)
+        html = html + '</span>'
+        if len(_label_cache) + len(missing) > LABEL_CACHE_SIZE:
+            _label_cache.clear()
+        for i, label in zip(missing, html):
+            _label_cache[keys[i]] = ui.HTML(label)
+    return [_label_cache[key] for key in keys]
+
+
+def limit_choices(choices: dict, selected=(), max_choices=MAX_CHOICES, hint=None) -> tuple:
+    # the first max_choices entries of an ordered choices dict plus the selected
+    # keys, and a note saying how many were left out (and hint, e.g. how to
+    # narrow the list), None when none were
+    keys = list(choices)[:max_choices]
+    shown = set(keys)
+    keys += [k for k in selected if k in choices and k not in shown]
+    limited = {k: choices[k] for k in keys}
+    hidden = len(choices) - len(limited)
+    note = f'{hidden:,} more not shown' + (f', {hint}' if hint else '') if hidden > 0 else None
+    return limited, note
+
+
+def more_choices_ui(note):
+    # the note of limit_choices, shown under its checkbox group
+    return ui.help_text(ui.tags.i(note), class_='more-choices') if note else None
@@ -0,0 +1,38 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+BASE_PATH='/Users/avashisth/workspace/aws-util/cost-explorer/data'
+GRAIL_ACCOUNTS = ['clinical', 'grail-sysinfra-eng', 'eng', 'grail-sysinfra-prod', 'grail-prod-galleri', 'msk',
+        'aws-grail-sequence-data-archives', 'grail-prod-mrd']
+
+
+def read_account_csvs(file_name, dtype, parse_dates, accounts=GRAIL_ACCOUNTS, max_workers=None):
+    # one reader thread per account, only the listed columns are read
+    paths = [f'{BASE_PATH}/metrics/{account}/{file_name}' for account in accounts]
+    usecols = list(dtype) + list(parse_dates)
+    def read(path):
+        return pd.read_csv(path, usecols=usecols, dtype=dtype, parse_dates=parse_dates)
+    with ThreadPoolExecutor(max_workers=max_workers or len(paths)) as executor:
+        frames = list(executor.map(read, paths))
+
+    # concat only keeps a categorical column when all frames share its categories
+    for column, column_dtype in dtype.items():
+        if column_dtype == 'category':
+            categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def period_start(timestamps, resolution):
+    # first day of the week (a Monday) or month each timestamp falls in
+    days = timestamps.values.astype('datetime64[D]')
+    if resolution == 'week':
+        # 1970-01-01, day 0, was a Thursday
+        starts = days - ((days.astype('int64') + 3) % 7).astype('timedelta64[D]')
+    elif resolution == 'month':
+        starts = days.astype('datetime64[M]')
+    else:
+        starts = days
+    return starts.astype(timestamps.values.dtype)
@@ -0,0 +1,111 @@
+import collections
+import io
+import tempfile
+import threading
+
+import pandas as pd
+
+
+# total size of the cached PNG images, least recently used ones are dropped first
+PLOT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PLOT_DPI = 96
+# browser sizes are rounded down to this many CSS pixels, so small resizes
+# reuse the cached images
+PLOT_SIZE_STEP = 20
+
+
+class PlotCache:
+    # LRU cache of rendered plot images shared by all sessions. Keys are built
+    # with plot_key() so the same view requested in a different order hits.
+
+    def __init__(self, max_bytes=PLOT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        # cached PNG bytes for key, render() is called on a miss and must
+        # return PNG bytes (or None for an empty plot, which is not cached)
+        with self.lock:
+            png = self.images.get(key)
+            if png is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return png
+            self.misses += 1
+        png = render()
+        if png is None:
+            return None
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = png
+                self.size += len(png)
+            while self.size > self.max_bytes and len(self.images) > 1:
+                _, old = self.images.popitem(last=False)
+                self.size -= len(old)
+        return png
+
+    def stats(self):
+        with self.lock:
+            return {'images': len(self.images), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def plot_key(*parts):
+    # canonical cache key: selections are order-insensitive, dates are days
+    key = []
+    for part in parts:
+        if isinstance(part, (list, tuple, set, frozenset)):
+            key.append(tuple(sorted(str(p) for p in part)))
+        elif hasattr(part, 'isoformat'):
+            key.append(pd.Timestamp(part).strftime('%Y-%m-%d'))
+        else:
+            key.append(part)
+    return tuple(key)
+
+
+def data_version(df, *value_columns):
+    # cheap fingerprint of a loaded frame (its size, last day and the totals of
+    # value_columns), part of every key so a reloaded snapshot never serves
+    # images of the previous one
+    return (len(df), str(df['timestamp'].max()),
+            *(round(float(df[column].sum()), 2) for column in value_columns))
+
+
+def client_size(session, output_id, width, height):
+    # (width, height, pixel ratio) of an output in the browser, in CSS pixels.
+    # width / height are used until the browser has reported the size. Reading
+    # it makes the calling render function rerun when the output is resized.
+    client = session.clientdata
+    width = client.output_width(output_id) or width
+    height = client.output_height(output_id) or height
+    try:
+        pixel_ratio = client.pixelratio() or 1
+    except ValueError:
+        pixel_ratio = 1
+    step = PLOT_SIZE_STEP
+    return (max(step, int(width) // step * step), max(step, int(height) // step * step),
+            pixel_ratio)
+
+
+def figure_png(fig, width, height, pixel_ratio=1, dpi=PLOT_DPI):
+    # width x height CSS pixels, drawn with pixel_ratio device pixels each
+    # imported on first use, pyplot is slow to import and startup should not wait
+    import matplotlib.pyplot as plt
+
+    fig.set_size_inches(width / dpi, height / dpi)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi * pixel_ratio)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def image_data(png, width, height):
+    # render.image only takes a file, it is deleted once sent (delete_file=True).
+    # width / height are the CSS pixel size the image was drawn for.
+    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+        f.write(png)
+    return {'src': f.name, 'width': width, 'height': height}
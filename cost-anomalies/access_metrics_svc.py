@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import sqlalchemy
+
+
+# any SQLAlchemy URL, e.g. sqlite:///access-metrics.db for a local stand-in of
+# the PIPELINE_BUCKET_ACCESS_METRICS table. Unset means the MySQL tunnel.
+ACCESS_METRICS_DB_URL = os.environ.get('ACCESS_METRICS_DB_URL')
+# connection pool of the shared engine, connections are recycled well before
+# MySQL's wait_timeout drops them and checked with a ping when handed out
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+DB_POOL_RECYCLE_SECS = 1800
+DB_POOL_TIMEOUT_SECS = 30
+# how long a query result is served from memory, and how many are kept
+ACCESS_METRICS_CACHE_TTL_SECS = int(os.environ.get('ACCESS_METRICS_CACHE_TTL_SECS', 600))
+ACCESS_METRICS_CACHE_SIZE = 32
+# (account, stage) bucket summaries kept in memory
+ACCESS_SUMMARY_CACHE_SIZE = 64
+# rows fetched from the database per round trip when streaming a result
+ACCESS_METRICS_CHUNK_ROWS = int(os.environ.get('ACCESS_METRICS_CHUNK_ROWS', 50_000))
+
+
+def mysql_url():
+    database_username = 'trimble'
+    database_password = 'trimble'
+    return sqlalchemy.engine.url.URL.create(
+        drivername="mysql+mysqlconnector",
+        username=database_username,
+        password=database_password,
+        host='127.0.0.1',
+        port=3316,
+        database='trimble',
+        query={"ssl_ca": '/Users/avashisth/.ssh/rds-combined-ca-bundle.pem'},
+    )
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    # one engine (and connection pool) per process, created on first use
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            url = sqlalchemy.engine.make_url(ACCESS_METRICS_DB_URL or mysql_url())
+            pool_args = dict(pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE_SECS)
+            if url.get_backend_name() != 'sqlite':
+                # sqlite picks its own pool class, which has no size settings
+                pool_args.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                 pool_timeout=DB_POOL_TIMEOUT_SECS)
+            _engine = sqlalchemy.create_engine(url, **pool_args)
+        return _engine
+
+
+class QueryCache:
+    # Query results by (sql, bound parameters), each one served for ttl
+    # seconds. The least recently used one is dropped when it is full.
+
+    def __init__(self, ttl=ACCESS_METRICS_CACHE_TTL_SECS, max_entries=ACCESS_METRICS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # queried outside the lock, two sessions may both miss the same key
+        value = load()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'results': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+query_cache = QueryCache()
+summary_cache = QueryCache(max_entries=ACCESS_SUMMARY_CACHE_SIZE)
+
+
+def cache_key(sql, params):
+    # list parameters (IN clauses) become tuples so the key is hashable
+    return str(sql), tuple(sorted(
+        (name, tuple(value) if isinstance(value, (list, tuple)) else value)
+        for name, value in params.items()))
+
+
+def read_sql(sql, params=None):
+    # result of a SELECT with bound parameters, served from query_cache while
+    # it is fresh. Shared, callers must not modify it.
+    params = params or {}
+    def load():
+        with get_engine().connect() as connection:
+            return pd.read_sql(sql, connection, params=params)
+    return query_cache.get(cache_key(sql, params), load)
+
+
+def read_sql_chunks(sql, params=None, chunksize=ACCESS_METRICS_CHUNK_ROWS):
+    # result frames of at most chunksize rows, streamed from a server side
+    # cursor (where the driver has one) instead of fetched all at once
+    with get_engine().connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        yield from pd.read_sql(sql, connection, params=params or {}, chunksize=chunksize)
+
+
+def like_contains(text):
+    # LIKE pattern matching text anywhere, with its wildcards escaped
+    escaped = text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return f'%{escaped}%'
+
+
+# columns of the per caller access counts and the grouping behind them
+ACCESS_COLUMNS = ['CallerType', 'CallerName', 'Bucket', 'GrailAccount']
+ACCESS_GROUP_BY = ['CallerType', 'CallerName', 'AccessType', 'Bucket', 'GrailAccount']
+
+
+def build_access_query(grail_accounts=None, pipeline_stage=None,
+                       columns=ACCESS_COLUMNS, group_by=ACCESS_GROUP_BY):
+    # SELECT of columns and SUM(AccessCount) CallCount per group_by, largest
+    # first, and its bound parameters. The filters run in the database:
+    # grail_accounts (None for all) and pipeline_stage, a text the bucket
+    # name contains. columns / group_by are ours, never user input.
+    where = []
+    params = {}
+    if grail_accounts is not None:
+        where.append('GrailAccount IN :grail_accounts')
+        params['grail_accounts'] = list(grail_accounts)
+    if pipeline_stage:
+        where.append("Bucket LIKE :bucket_pattern ESCAPE '!'")
+        params['bucket_pattern'] = like_contains(pipeline_stage)
+    sql = sqlalchemy.text(f"""
+        SELECT
+            {', '.join(columns)},
+            SUM(pbam.AccessCount) CallCount
+        FROM PIPELINE_BUCKET_ACCESS_METRICS pbam
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        GROUP BY {', '.join(group_by)}
+        ORDER BY CallCount DESC
+    """)
+    if 'grail_accounts' in params:
+        sql = sql.bindparams(sqlalchemy.bindparam('grail_accounts', expanding=True))
+    return sql, params
+
+
+def get_access_counts(grail_accounts=None, pipeline_stage=None):
+    # access counts per caller, bucket and account, largest first
+    df = read_sql(*build_access_query(grail_accounts, pipeline_stage))
+    # CONCAT is not portable (sqlite has none), the caller label is built here
+    df = df.assign(Caller=df['CallerType'].astype(str) + '/' + df['CallerName'].astype(str))
+    return df[['Caller', 'Bucket', 'GrailAccount', 'CallCount']]
+
+
+def get_grail_accounts():
+    return read_sql(sqlalchemy.text(
+        "SELECT DISTINCT GrailAccount FROM PIPELINE_BUCKET_ACCESS_METRICS ORDER BY GrailAccount"))
+
+
+def get_bucket_access_summary(grail_accounts, pipeline_stage):
+    # access counts per bucket and account of the given accounts and stage,
+    # largest first. Only the matching groups leave the database, each streamed
+    # chunk is added into the running totals and dropped, so at most one chunk
+    # is held next to the summary. The summary is kept per (accounts, stage).
+    # Shared, callers must not modify it.
+    keys = ['Bucket', 'GrailAccount']
+    sql, params = build_access_query(grail_accounts, pipeline_stage,
+                                     columns=keys, group_by=keys)
+    def load():
+        totals = None
+        for chunk in read_sql_chunks(sql, params):
+            counts = chunk.groupby(by=keys)['CallCount'].sum()
+            totals = counts if totals is None else totals.add(counts, fill_value=0)
+        if totals is None:
+            return pd.DataFrame(columns=keys + ['CallCount'])
+        # add() with fill_value turns integer counts into floats
+        return totals.astype(counts.dtype).sort_values(ascending=False).reset_index()
+    key = (tuple(sorted(grail_accounts)) if grail_accounts is not None else None, pipeline_stage)
+    return summary_cache.get(key, load)
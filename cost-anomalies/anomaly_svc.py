@@ -1,6 +1,10 @@
 from statistics import mode
-from pycaret.anomaly import * 
 import numpy as np
+import pandas as pd
+
+# 'hbos' is the built in numpy port of pycaret's 'histogram' model (pyod HBOS),
+# 'histogram' still runs the pycaret model. pycaret is only imported when used.
+HIST_MA_MODEL = 'hbos'
 
 # model can be iforest, histogram etc. ..
 # check  https://towardsdatascience.com/time-series-anomaly-detection-with-pycaret-706a6e2b2427
@@ -17,6 +21,7 @@ def detect_anomalies(data,model='histogram'):
     data['week_of_year'] = [i.weekofyear for i in data.index]
     data['is_weekday'] = [i.isoweekday() for i in data.index]
     
+    from pycaret.anomaly import setup, create_model, assign_model
     s = setup(data, session_id = 123, verbose= False)
 
     iforest = create_model(model, fraction = 0.2)
@@ -39,7 +44,21 @@ def detect_anomalies_laymans_way_01(data):
     data['Anomaly'] = data['Anomaly_Score'] > 0
     return data
 
-def detect_anomalies_hist_ma(data,value_column='MetricValue'):
+def hbos_scores(values, n_bins=10, alpha=0.1):
+    # same scores as pyod's HBOS with static bins on a single feature
+    values = np.asarray(values, dtype=float)
+    hist, edges = np.histogram(values, bins=n_bins, density=True)
+    bins = np.clip(np.digitize(values, edges, right=True) - 1, 0, n_bins - 1)
+    return -np.log2(hist[bins] + alpha)
+
+
+def hbos_labels(scores, fraction=0.1):
+    threshold = np.percentile(scores, 100 * (1 - fraction))
+    return (scores > threshold).astype(int)
+
+
+def detect_anomalies_hist_ma(data,value_column='MetricValue',model=None):
+    model = model or HIST_MA_MODEL
     data_copy = data.copy()
     if data.shape[0] < 30:
         print(f"Can not detect anomalies with fewer than a month's reads")
@@ -60,20 +79,188 @@ def detect_anomalies_hist_ma(data,value_column='MetricValue'):
         data_copy['Anomaly_Score'] = -1
         return data_copy
     
-    s = setup(data, session_id = 123,verbose=False)
-    model = create_model('histogram', fraction = 0.1)
-    model_results = assign_model(model)
+    if model == 'histogram':
+        from pycaret.anomaly import setup, create_model, assign_model
+        s = setup(data, session_id = 123,verbose=False)
+        model = create_model('histogram', fraction = 0.1)
+        model_results = assign_model(model)
+    elif model == 'hbos':
+        model_results = data.copy()
+        model_results['Anomaly_Score'] = hbos_scores(data['MA7WD'].values)
+        model_results['Anomaly'] = hbos_labels(model_results['Anomaly_Score'].values, fraction = 0.1)
+    else:
+        raise ValueError(f'Unknown anomaly model {model}')
     
-    model_results['timestamp'] = data_copy_w['timestamp'].apply(lambda x: x.strftime('%Y-%V'))
+    model_results['timestamp'] = data_copy_w['timestamp'].apply(lambda x: x.strftime('%G-%V')).values
     
     results_df = model_results[['timestamp','Anomaly', 'Anomaly_Score']].set_index('timestamp')
     
     orig_columns = list(data_copy.columns)
 
-    data_copy['timestamp_yw'] = data_copy['timestamp'].apply(lambda x: x.strftime('%Y-%V'))
+    data_copy['timestamp_yw'] = data_copy['timestamp'].apply(lambda x: x.strftime('%G-%V'))
 
-    data_with_anomaly_info =  data_copy.join(results_df,on='timestamp_yw').fillna(-1)
+    # only the result columns, the dimensions are categoricals without a -1
+    data_with_anomaly_info =  data_copy.join(results_df,on='timestamp_yw')\
+        .fillna({'Anomaly': -1, 'Anomaly_Score': -1})
     data_with_anomaly_info['Anomaly'] = data_with_anomaly_info['Anomaly'] == 1
 
     data_with_anomaly_info =  data_with_anomaly_info[ orig_columns + ['Anomaly', 'Anomaly_Score']]
-    return data_with_anomaly_info
\ No newline at end of file
+    return data_with_anomaly_info
+
+
+def hbos_scores_2d(values, counts, n_bins=10, alpha=0.1):
+    # hbos_scores for every row of a 2-d array at once, row i holds counts[i]
+    # values followed by nan padding. Bin edges and the bin lookup mirror
+    # np.histogram and pyod so each row scores exactly like hbos_scores.
+    valid = np.arange(values.shape[1])[None, :] < counts[:, None]
+    lo = np.where(counts > 0, np.where(valid, values, np.inf).min(axis=1), 0)
+    hi = np.where(counts > 0, np.where(valid, values, -np.inf).max(axis=1), 0)
+    same = lo == hi
+    lo, hi = np.where(same, lo - 0.5, lo), np.where(same, hi + 0.5, hi)
+    edges = np.arange(n_bins + 1)[None, :] * ((hi - lo) / n_bins)[:, None] + lo[:, None]
+    edges[:, -1] = hi
+
+    x = np.where(valid, values, lo[:, None])[:, :, None]
+    hist_bins = (x >= edges[:, None, 1:n_bins]).sum(axis=2)
+    hist = ((hist_bins[:, :, None] == np.arange(n_bins)) & valid[:, :, None]).sum(axis=1)
+    density = hist / np.diff(edges, axis=1) / np.maximum(counts, 1)[:, None]
+
+    score_bins = np.clip((x > edges[:, None, :]).sum(axis=2) - 1, 0, n_bins - 1)
+    scores = -np.log2(np.take_along_axis(density, score_bins, axis=1) + alpha)
+    return np.where(valid, scores, np.nan)
+
+
+def hbos_labels_2d(scores, fraction=0.1):
+    scored = ~np.isnan(scores).all(axis=1)
+    threshold = np.full(scores.shape[0], np.inf)
+    threshold[scored] = np.nanpercentile(scores[scored], 100 * (1 - fraction), axis=1)
+    return scores > threshold[:, None]
+
+
+def detect_anomalies_hist_ma_batch(df,value_column='Cost',
+                                   keys=('GrailAccount','Service','UsageType','UsageUnit'),
+                                   fraction=0.1):
+    # detect_anomalies_hist_ma(model='hbos') for every series of a long frame in one
+    # pass: the series are laid out as columns of a (day x series) array, MA7 is a
+    # column-wise rolling mean, Saturdays are compacted into a (series x week) array
+    # and scored with hbos_scores_2d. Rows of a series are taken in timestamp order.
+    keys = list(keys)
+    data = df.reset_index(drop=True)
+    if data.empty:
+        data['Anomaly'] = pd.Series(dtype=bool)
+        data['Anomaly_Score'] = pd.Series(dtype=float)
+        return data
+    order = np.lexsort((data['timestamp'].values,
+                        data.groupby(by=keys, observed=True, sort=False).ngroup().values))
+    data = data.iloc[order].reset_index(drop=True)
+    sid = data.groupby(by=keys, observed=True, sort=False).ngroup().values
+    n_series = sid.max() + 1
+    counts = np.bincount(sid, minlength=n_series)
+    pos = np.arange(len(sid)) - (np.cumsum(counts) - counts)[sid]
+
+    values = np.full((counts.max(), n_series), np.nan)
+    values[pos, sid] = data[value_column].astype(float).values
+    # one rolling pass over all columns, same arithmetic as the per series rolling mean
+    ma7 = (pd.DataFrame(values).rolling(7).mean().fillna(0).values + 0.0001).T
+
+    saturday = (data['timestamp'].dt.dayofweek == 5).values
+    sat_sid, sat_row = sid[saturday], pos[saturday]
+    sat_counts = np.bincount(sat_sid, minlength=n_series)
+    sat_pos = np.arange(len(sat_sid)) - (np.cumsum(sat_counts) - sat_counts)[sat_sid]
+    weekly = np.full((n_series, sat_counts.max() if len(sat_sid) else 0), np.nan)
+    weekly[sat_sid, sat_pos] = ma7[sat_sid, sat_row]
+    ma7wd = np.diff(weekly, axis=1, prepend=np.nan)
+    ma7wd[:, :1] = 0
+
+    scores = hbos_scores_2d(ma7wd, sat_counts)
+    labels = hbos_labels_2d(scores, fraction)
+
+    iso = data['timestamp'].dt.isocalendar()
+    year_week = iso['year'].astype('int64').values * 100 + iso['week'].astype('int64').values
+    weekly_results = pd.DataFrame({
+        'sid': sat_sid,
+        'year_week': year_week[saturday],
+        'Anomaly': labels[sat_sid, sat_pos],
+        'Anomaly_Score': scores[sat_sid, sat_pos],
+    }).drop_duplicates(subset=['sid','year_week'])
+    # series shorter than a month or four weeks are not scored
+    scored = (counts >= 30) & (sat_counts >= 4)
+    weekly_results = weekly_results[scored[weekly_results['sid'].values]]
+
+    results = pd.DataFrame({'sid': sid, 'year_week': year_week})\
+        .merge(weekly_results, on=['sid','year_week'], how='left')
+    data['Anomaly'] = (results['Anomaly'] == True).values
+    data['Anomaly_Score'] = results['Anomaly_Score'].fillna(-1).values
+    return data
+
+
+def compare_hist_ma_models(data,value_column='MetricValue'):
+    # scores the same series with the built in and the pycaret histogram model
+    hbos = detect_anomalies_hist_ma(data.copy(),value_column,model='hbos')
+    pycaret = detect_anomalies_hist_ma(data.copy(),value_column,model='histogram')
+    return {
+        'max_score_diff': (hbos['Anomaly_Score'] - pycaret['Anomaly_Score']).abs().max(),
+        'label_mismatches': int((hbos['Anomaly'] != pycaret['Anomaly']).sum()),
+    }
+
+
+SERIES_KEYS = ['GrailAccount', 'Service', 'UsageType', 'UsageUnit']
+
+
+def hist_ma_fixture(seed=123):
+    # daily costs of a few series in the schema get_cnu_df() loads: categorical
+    # dimensions (some with missing values), a weekly cycle and spend jumps.
+    # The series start on different weekdays, one has missing days and the
+    # last ones are too short to be scored.
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i, days in enumerate([365, 300, 200, 120, 60, 35, 25, 10]):
+        timestamp = pd.date_range(pd.Timestamp('2022-01-01') + pd.Timedelta(days=i), periods=days, freq='D')
+        cost = 100*(i + 1) + 10*np.sin(np.arange(days)*2*np.pi/7) + rng.normal(0, 2, days)
+        cost[days//3:days//3 + 7] += 80
+        cost[2*days//3:] += 40
+        frame = pd.DataFrame({'timestamp': timestamp, 'UsageType': f'usage-{i}', 'Cost': cost})
+        frames.append(frame.drop(index=rng.choice(days, 12, replace=False)) if i == 1 else frame)
+    fixture = pd.concat(frames, ignore_index=True)
+    fixture['GrailAccount'] = 'clinical'
+    fixture['Service'] = 'Amazon Simple Storage Service'
+    fixture['UsageUnit'] = 'GB-Mo'
+    fixture['Currency'] = np.where(np.arange(len(fixture)) % 50 == 0, None, 'USD')
+    return fixture.astype({column: 'category' for column in SERIES_KEYS + ['Currency']})
+
+
+def check_hbos_model():
+    # asserts the built in model against hand computed HBOS scores and the
+    # batched detector against the per series one on hist_ma_fixture().
+    # Run by `python anomaly_svc.py`.
+
+    # nine values in the first of ten unit wide bins (density 0.9), one in the
+    # last (density 0.1), scored -log2(density + 0.1)
+    scores = hbos_scores([0]*9 + [10])
+    assert np.allclose(scores, [0]*9 + [-np.log2(0.2)])
+    assert list(hbos_labels(scores)) == [0]*9 + [1]
+    # as in pyod, a value on the upper edge of a bin is scored with that bin
+    # (the 1s with the 0s), and scores tied at the threshold are not outliers
+    scores = hbos_scores([0]*5 + [1]*3 + [10]*2)
+    assert np.allclose(scores, [-np.log2(0.6)]*8 + [-np.log2(0.3)]*2)
+    assert not hbos_labels(scores).any()
+
+    batch = detect_anomalies_hist_ma_batch(hist_ma_fixture(), 'Cost', keys=SERIES_KEYS)
+    assert batch['Anomaly'].any()
+    for key, data in batch.groupby(by=SERIES_KEYS, observed=True):
+        series = detect_anomalies_hist_ma(
+            data.drop(columns=['Anomaly', 'Anomaly_Score']).reset_index(drop=True), 'Cost', model='hbos')
+        assert np.array_equal(series['Anomaly'].values, data['Anomaly'].values), key
+        assert np.array_equal(series['Anomaly_Score'].values, data['Anomaly_Score'].values), key
+
+
+if __name__ == '__main__':
+    check_hbos_model()
+    print('hbos model checks passed')
+    try:
+        import pycaret  # noqa: F401
+    except ImportError:
+        print('pycaret is not installed, the comparison with its histogram model is skipped')
+    else:
+        for key, data in hist_ma_fixture().groupby(by=SERIES_KEYS, observed=True):
+            print(key, compare_hist_ma_models(data.reset_index(drop=True), 'Cost'))
@@ -0,0 +1,8 @@
+# puts the repo's common/ directory, the modules both apps share, on the
+# import path. Import it before any of them.
+import os
+import sys
+
+COMMON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common')
+if COMMON_DIR not in sys.path:
+    sys.path.insert(0, COMMON_DIR)
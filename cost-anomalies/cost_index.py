@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+
+INDEX_DIMENSIONS = ['GrailAccount', 'Service', 'UsageType']
+
+
+class CostIndex:
+    # Row position index over a cost frame for the explorer's cascading filters.
+    # Rows are kept sorted by timestamp so a date range is a binary search, and
+    # each dimension keeps a posting list (sorted row positions) per value.
+
+    def __init__(self, df: pd.DataFrame):
+        if not df['timestamp'].is_monotonic_increasing:
+            df = df.sort_values(by='timestamp', kind='stable').reset_index(drop=True)
+        self.df = df
+        self.timestamps = df['timestamp'].values
+        self.postings = {}
+        for column in INDEX_DIMENSIONS:
+            values = df[column].astype('category')
+            codes = values.cat.codes.values
+            # int32 positions take half the memory, frames stay below 2**31 rows
+            order = np.argsort(codes, kind='stable').astype(np.int32)
+            bounds = np.searchsorted(codes[order], np.arange(len(values.cat.categories) + 1))
+            self.postings[column] = {
+                category: order[bounds[i]:bounds[i + 1]]
+                for i, category in enumerate(values.cat.categories)
+            }
+
+    def date_bounds(self, startD, endD):
+        bounds = pd.DatetimeIndex([startD, endD]).values.astype(self.timestamps.dtype)
+        return np.searchsorted(self.timestamps, bounds)
+
+    def filter(self, date_range, accounts=None, services=None, usage_types=None):
+        # positions of rows with startD <= timestamp < endD and, for every
+        # dimension that is not None, a value in the given list
+        lo, hi = self.date_bounds(*date_range)
+        selected = np.ones(hi - lo, dtype=bool)
+        for column, values in zip(INDEX_DIMENSIONS, (accounts, services, usage_types)):
+            if values is None:
+                continue
+            mask = np.zeros(hi - lo, dtype=bool)
+            postings = self.postings[column]
+            for value in values:
+                positions = postings.get(value)
+                if positions is None:
+                    continue
+                positions = positions[np.searchsorted(positions, lo):np.searchsorted(positions, hi)]
+                mask[positions - lo] = True
+            selected &= mask
+        return np.flatnonzero(selected) + lo
+
+    def take(self, positions):
+        return self.df.iloc[positions]
+
+    def slice(self, date_range, accounts=None, services=None, usage_types=None):
+        return self.take(self.filter(date_range, accounts, services, usage_types))
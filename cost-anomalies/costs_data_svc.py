@@ -1,109 +1,179 @@
-import sqlalchemy
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import contextlib
+import fcntl
 import os
+import tempfile
 import time 
 import datetime
+import collections
+import resource
+import sys
 import anomaly_svc
+import common_path  # noqa: F401
+from metrics_io import read_account_csvs, period_start
+import access_metrics_svc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List
 
 
 
-class ComputeUsageAggregator:
-    def __init__(self,usage_type_token='SpotUsage'):
-        self.usage_type_token = usage_type_token
-        self.service = "Amazon Elastic Compute Cloud - Compute"
-        
-    def get_ut_group_dfs(self,df: pd.DataFrame)->List[pd.DataFrame]:
-        service = self.service
-        usage_type_token = self.usage_type_token
-        df_query = "Service == @service and UsageType.str.contains(@usage_type_token)"
-        data = df.query(df_query).copy().reset_index()
-        all_usage_types = data['UsageType'].unique().tolist()
-        usage_type_groups = set()
-        for ut in all_usage_types:
-            usage_type_groups.add(ut.split(':')[0])
-            # usage_type_groups.add(ut.split('.')[0])
-        
-        columns = df.columns
-        value_cols = ['UnitsUsed','Cost']
-        sub_cols = list(set(columns)-set(['UsageType']))
-        group_by_cols = list(set(sub_cols) -set(value_cols))
-
-        group_dataframes = []
-        for ut_group in usage_type_groups:
-            sub_query = "UsageType.str.startswith(@ut_group)"
-            sub_data = data.query(sub_query)[sub_cols].groupby(by=group_by_cols).sum().reset_index()
-            sub_data['UsageType'] = f"{ut_group}:all.all"
-            sub_data = sub_data[columns]
-            group_dataframes.append(sub_data)
-            
-        return group_dataframes
-        
-
-    def extend_and_drop(self,df: pd.DataFrame):
-        service = self.service
-        usage_type_token = self.usage_type_token
-        df_query = "not( Service == @service and UsageType.str.contains(@usage_type_token) )"
-        group_dataframes = self.get_ut_group_dfs(df)
-        return pd.concat([df.query(df_query)]+group_dataframes)
-
-
-def get_mysql_engine():
-    database_username = 'trimble'
-    database_password = 'trimble'
-    db_url = sqlalchemy.engine.url.URL.create(
-        drivername="mysql+mysqlconnector",
-        username=database_username,
-        password=database_password,
-        host='127.0.0.1',
-        port=3316,
-        database='trimble',
-        query={"ssl_ca": '/Users/avashisth/.ssh/rds-combined-ca-bundle.pem'},
-    )
-    engine = sqlalchemy.create_engine(db_url, pool_recycle=1, pool_timeout=57600)
-    return engine
+# usage types of `service` containing `usage_type_token` are rolled up into
+# '<prefix><separator>all.all', prefix being the usage type up to the separator.
+# Rules are applied in order and the first matching rule wins.
+UsageRollupRule = collections.namedtuple('UsageRollupRule', ['service', 'usage_type_token', 'separator'])
 
-def get_df():
-    query = """
-        SELECT 
-            CONCAT(CallerType,'/',CallerName) Caller ,
-            Bucket, 
-            GrailAccount,
-            SUM(pbam.AccessCount) CallCount  
-        FROM PIPELINE_BUCKET_ACCESS_METRICS pbam 
-        GROUP BY CallerType,CallerName,AccessType,Bucket,GrailAccount
-        ORDER BY CallCount DESC
-    """
-    df = pd.read_sql(query,get_mysql_engine())
-    return df
+COMPUTE_SERVICE = "Amazon Elastic Compute Cloud - Compute"
+USAGE_ROLLUP_RULES = [
+    UsageRollupRule(COMPUTE_SERVICE, 'SpotUsage', ':'),
+    UsageRollupRule(COMPUTE_SERVICE, 'BoxUsage', ':'),
+]
+
+
+def get_usage_rollup_keys(df: pd.DataFrame, rules: List[UsageRollupRule]) -> pd.DataFrame:
+    # the rules are evaluated once per distinct (Service, UsageType) pair
+    pairs = df[['Service','UsageType']].drop_duplicates().reset_index(drop=True)
+    pairs['RollupUsageType'] = None
+    for rule in rules:
+        matches = pairs['RollupUsageType'].isnull() \
+            & (pairs['Service'] == rule.service) \
+            & pairs['UsageType'].astype(str).str.contains(rule.usage_type_token, regex=False)
+        prefixes = pairs.loc[matches, 'UsageType'].astype(str).str.split(rule.separator).str[0]
+        pairs.loc[matches, 'RollupUsageType'] = prefixes + f'{rule.separator}all.all'
+    pairs = pairs.dropna(subset=['RollupUsageType'])
+    pairs['RollupUsageType'] = pairs['RollupUsageType'].astype('category')
+    return pairs
 
-def get_cnu_df():
-    BASE_PATH='/Users/avashisth/workspace/aws-util/cost-explorer/data'
-    gaccts = ['clinical', 'grail-sysinfra-eng', 'eng', 'grail-sysinfra-prod', 'grail-prod-galleri', 'msk',
-            'aws-grail-sequence-data-archives', 'grail-prod-mrd']
-    df = pd.concat([
-        pd.read_csv(f'{BASE_PATH}/metrics/{account}/cost-n-usage-x-svc-usetype.csv.gz')
-        for account in gaccts
-    ])    
-    
-    dfu = df.query('MetricName == "UsageQuantity"')[['Start', 'GrailAccount', 'SERVICE', 'USAGE_TYPE', 'Unit', 'Amount']]
-    dfu.columns = ['Start', 'GrailAccount', 'Service', 'UsageType', 'UsageUnit', 'UnitsUsed']
 
-    dfc = df.query('MetricName == "BlendedCost"')[['Start', 'GrailAccount', 'SERVICE', 'USAGE_TYPE', 'Unit', 'Amount']]
-    dfc.columns = ['Start', 'GrailAccount', 'Service', 'UsageType', 'Currency', 'Cost']
+def rollup_usage_types(df: pd.DataFrame, rules: List[UsageRollupRule]=USAGE_ROLLUP_RULES,
+                       value_cols=None) -> pd.DataFrame:
+    columns = list(df.columns)
+    value_cols = list(value_cols or ['UnitsUsed','Cost'] + [m for m in CNU_EXTRA_METRICS if m in columns])
+    group_by_cols = [c for c in columns if c not in value_cols and c != 'UsageType']
 
-    # dfc.shape,dfu.shape
+    keys = get_usage_rollup_keys(df, rules)
+    rollup_usage_type = df[['Service','UsageType']]\
+        .merge(keys, on=['Service','UsageType'], how='left')['RollupUsageType'].values
+    rolled = pd.notnull(rollup_usage_type)
 
+    grouped = df[rolled][group_by_cols + value_cols]\
+        .assign(UsageType=rollup_usage_type[rolled])\
+        .groupby(by=group_by_cols + ['UsageType'], observed=True)\
+        .sum().reset_index()[columns]
+    return pd.concat([df[~rolled], grouped], ignore_index=True)
 
-    dfc = dfc.set_index(['Start', 'GrailAccount', 'Service', 'UsageType'])\
-        .join(dfu.set_index(['Start', 'GrailAccount', 'Service', 'UsageType']),how='left').reset_index()
-    
-    dfc['UsageMonth'] = dfc['Start'].apply(lambda x: f'{x[:7]}-01')
-    dfc['UsageUnit'] = dfc['UsageUnit'].fillna('NotAvailable')
-    dfc['timestamp'] = pd.to_datetime(dfc['Start'])           
+
+def get_df():
+    # access counts per caller / bucket / account, from the shared pooled
+    # engine and served from its result cache while fresh
+    return access_metrics_svc.get_access_counts()
+
+CNU_CSV_DTYPES = {
+    'GrailAccount': 'category',
+    'SERVICE': 'category',
+    'USAGE_TYPE': 'category',
+    'MetricName': 'category',
+    'Unit': 'category',
+    'Amount': 'float64',
+}
+
+
+def benchmark(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+    print(f'{fn.__name__}: {elapsed:.2f}s, peak rss {peak_rss_mb:,.0f} MB')
+    return result
+
+
+def memory_report(df):
+    # bytes held per column (strings counted in full), largest first
+    usage = df.memory_usage(index=True, deep=True)
+    report = pd.DataFrame({
+        'dtype': [str(df.index.dtype)] + [str(df[c].dtype) for c in df.columns],
+        'MB': (usage / 1024**2).round(2).values,
+    }, index=usage.index)
+    report['Share'] = (report['MB'] / report['MB'].sum()).round(3)
+    report = report.sort_values(by='MB', ascending=False)
+    print(report)
+    print(f'{len(df):,} rows, {report["MB"].sum():,.1f} MB, '
+          f'{usage.sum() / max(len(df), 1):.1f} bytes per row')
+    return report
+
+
+# MetricName -> (amount column, unit column) of the cost and usage frame
+CNU_METRICS = {
+    'BlendedCost': ('Cost', 'Currency'),
+    'UsageQuantity': ('UnitsUsed', 'UsageUnit'),
+}
+# other cost metrics become extra amount columns named after the metric, when
+# the exported files contain them
+CNU_EXTRA_METRICS = ['UnblendedCost', 'AmortizedCost', 'NetAmortizedCost']
+
+
+def pivot_cnu_metrics(df, extra_metrics=CNU_EXTRA_METRICS):
+    # one row per (Start, account, service, usage type) with a column per metric.
+    # Output rows are numbered with a single groupby and amounts / unit codes are
+    # scattered into (row x metric) arrays. Rows without a BlendedCost are dropped.
+    keys = ['Start', 'GrailAccount', 'SERVICE', 'USAGE_TYPE']
+    metrics = list(CNU_METRICS) + list(extra_metrics)
+    df = df[df['MetricName'].isin(metrics)]
+    row = df.groupby(by=keys, observed=True, sort=False).ngroup().values
+    metric = pd.Categorical(df['MetricName'], categories=metrics).codes
+    n_rows = row.max() + 1 if len(row) else 0
+
+    amounts = np.full((n_rows, len(metrics)), np.nan)
+    amounts[row, metric] = df['Amount'].values
+    unit_codes = np.full((n_rows, len(metrics)), -1, dtype=df['Unit'].cat.codes.dtype)
+    unit_codes[row, metric] = df['Unit'].cat.codes.values
+    present = np.bincount(metric, minlength=len(metrics)) > 0
+
+    _, first = np.unique(row, return_index=True)
+    dfc = df.iloc[first][keys].reset_index(drop=True)
+    for i, metric_name in enumerate(metrics):
+        if metric_name in CNU_METRICS:
+            amount_column, unit_column = CNU_METRICS[metric_name]
+            dfc[unit_column] = pd.Categorical.from_codes(unit_codes[:, i], dtype=df['Unit'].dtype)
+            dfc[amount_column] = amounts[:, i]
+        elif present[i]:
+            dfc[metric_name] = amounts[:, i]
+    dfc = dfc[dfc['Cost'].notnull()].reset_index(drop=True)
+    return dfc.rename(columns={'SERVICE': 'Service', 'USAGE_TYPE': 'UsageType'})
+
+
+# compact schema of the cost and usage frame: dimensions are categoricals and
+# timestamp is the only date column. Cost stays float64, its totals are shown
+# to the cent and float32 drifts by dollars over millions of rows.
+CNU_COLUMN_DTYPES = {
+    'GrailAccount': 'category',
+    'Service': 'category',
+    'UsageType': 'category',
+    'UsageUnit': 'category',
+    'Currency': 'category',
+    'Cost': 'float64',
+    'UnitsUsed': 'float32',
+    'Anomaly': 'bool',
+    'Anomaly_Score': 'float32',
+    **{metric: 'float32' for metric in CNU_EXTRA_METRICS},
+}
+
+
+def compact_cnu_df(df):
+    # cast the columns present in df to CNU_COLUMN_DTYPES
+    dtypes = {c: t for c, t in CNU_COLUMN_DTYPES.items() if c in df.columns and df[c].dtype != t}
+    return df.astype(dtypes) if dtypes else df
 
 
-    return dfc
+def get_cnu_df():
+    df = read_account_csvs('cost-n-usage-x-svc-usetype.csv.gz', CNU_CSV_DTYPES, parse_dates=['Start'])
+    dfc = pivot_cnu_metrics(df).rename(columns={'Start': 'timestamp'})
+    dfc['UsageUnit'] = dfc['UsageUnit'].cat.add_categories(['NotAvailable']).fillna('NotAvailable')
+    return compact_cnu_df(dfc)
 
 # def get_cnu_df():
 
@@ -145,12 +215,8 @@ def get_cnu_df():
 #     return dfu
 
 def get_cnu_df_with_grouped_usages():
-    spotUsageAggregator = ComputeUsageAggregator('SpotUsage')
-    boxUsageAggregator = ComputeUsageAggregator('BoxUsage')
-    df = get_cnu_df()
-    df = spotUsageAggregator.extend_and_drop(df)
-    df = boxUsageAggregator.extend_and_drop(df)
-    return df
+    # rolled up usage types come back as strings
+    return compact_cnu_df(rollup_usage_types(get_cnu_df()))
 
 def get_anomalies(df,grail_acct,service,usage_type,model='laymans_way'):
     df_query = "GrailAccount == @grail_acct"+\
@@ -171,48 +237,333 @@ def get_anomalies_using_ma(df,grail_acct,service,usage_type,usage_unit):
     return data_with_anomaly_info
 
 
-cnu_with_anomaly_info_path = '/Users/avashisth/sandbox/R/cnu_with_anomaly_info.csv.gz'
+# bump when the columns / encoding of the snapshot change, older files are rebuilt
+SNAPSHOT_VERSION = 3
+SNAPSHOT_MAX_AGE = 3600*24
+SNAPSHOT_ROW_GROUP_SIZE = 128*1024
+SERIES_KEYS = ['GrailAccount', 'Service', 'UsageType', 'UsageUnit']
+
+cnu_with_anomaly_info_path = '/Users/avashisth/sandbox/R/cnu_with_anomaly_info.parquet'
+cnu_series_state_path = '/Users/avashisth/sandbox/R/cnu_series_state.parquet'
+# held by the one process (app worker or command line run) rebuilding the snapshot
+cnu_snapshot_lock_path = f'{cnu_with_anomaly_info_path}.lock'
+
+# number of processes scoring series in parallel, defaults to all cores
+ANOMALY_WORKERS = int(os.environ.get('ANOMALY_WORKERS', os.cpu_count() or 1))
+# share of the scored series allowed to fail before the rebuild is given up
+# and the previous snapshot kept
+ANOMALY_MAX_FAILED_SHARE = 0.5
+
+
+def get_snapshot_version(path=None):
+    path = path or cnu_with_anomaly_info_path
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    return int(metadata.get(b'snapshot_version', b'0'))
+
+
+def is_snapshot_fresh(path=None, max_age=SNAPSHOT_MAX_AGE):
+    path = path or cnu_with_anomaly_info_path
+    return get_snapshot_version(path) == SNAPSHOT_VERSION \
+        and time.time() - os.path.getmtime(path) < max_age
+
+
+def write_parquet_atomically(table, path, **kwargs):
+    # written to a temp file of its own next to path and moved over it, readers
+    # see the old or the new file, never a partial one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        # mkstemp creates it readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        pq.write_table(table, tmp_path, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_snapshot(df, path=None):
+    path = path or cnu_with_anomaly_info_path
+    # rows are sorted by timestamp so that each row group covers a narrow date
+    # range and its min/max statistics can be used to skip it on read
+    df = compact_cnu_df(df.sort_values(by=['timestamp','Service','UsageType']).reset_index(drop=True))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'snapshot_version'] = str(SNAPSHOT_VERSION).encode()
+    table = table.replace_schema_metadata(metadata)
+    write_parquet_atomically(table, path, row_group_size=SNAPSHOT_ROW_GROUP_SIZE,
+                             compression='zstd')
+
+
+def read_snapshot(path=None, columns=None, startD=None, endD=None):
+    path = path or cnu_with_anomaly_info_path
+    filters = []
+    if startD is not None:
+        filters.append(('timestamp', '>=', pd.Timestamp(startD)))
+    if endD is not None:
+        filters.append(('timestamp', '<', pd.Timestamp(endD)))
+    table = pq.read_table(path, columns=columns, filters=filters or None)
+    return compact_cnu_df(table.to_pandas())
+
+
+def get_series_state(df):
+    # one row per (account, service, usage type, unit) series with its watermark
+    # and a content hash over (timestamp, Cost). Row hashes are shifted down to 40
+    # bits before summing so the per series sum can not overflow int64.
+    row_hashes = pd.util.hash_pandas_object(df[['timestamp','Cost']], index=False).values >> 24
+    state = df[SERIES_KEYS+['timestamp']]\
+        .assign(ContentHash=row_hashes.astype('int64'), Rows=1)\
+        .groupby(by=SERIES_KEYS, observed=True)\
+        .agg(LastTimestamp=('timestamp','max'), Rows=('Rows','sum'), ContentHash=('ContentHash','sum'))\
+        .reset_index()
+    return state
+
+
+def read_series_state(path=None):
+    path = path or cnu_series_state_path
+    if not os.path.exists(path) or get_snapshot_version() != SNAPSHOT_VERSION:
+        return None
+    return pq.read_table(path).to_pandas()
+
+
+def write_series_state(state, path=None):
+    path = path or cnu_series_state_path
+    write_parquet_atomically(pa.Table.from_pandas(state, preserve_index=False), path)
+
+
+def get_changed_series(state, previous_state):
+    if previous_state is None:
+        return state
+    merged = state.merge(previous_state, on=SERIES_KEYS, how='left', suffixes=('', '_previous'))
+    changed = merged['ContentHash_previous'].isnull() \
+        | (merged['ContentHash'] != merged['ContentHash_previous']) \
+        | (merged['Rows'] != merged['Rows_previous']) \
+        | (merged['LastTimestamp'] != merged['LastTimestamp_previous'])
+    return state[changed.values]
+
+
+def _score_series(key, data):
+    # runs in a worker process, errors are returned instead of raised so that
+    # one bad series does not abort the whole refresh
+    try:
+        return key, anomaly_svc.detect_anomalies_hist_ma(data, 'Cost'), None
+    except Exception as e:
+        return key, None, repr(e)
+
+
+def _no_anomalies(data):
+    data = data.copy()
+    data['Anomaly'] = False
+    data['Anomaly_Score'] = -1
+    return data
+
+
+def score_series_parallel(df, series_df, workers=None, progress_every=100,
+                          max_failed_share=ANOMALY_MAX_FAILED_SHARE):
+    # scored frames of the series in series_df, and the keys of the series that
+    # failed. Those are returned without anomalies so they are still shown, but
+    # must not be recorded as scored. Raises when more than max_failed_share of
+    # the series fail, a broken model would otherwise save a snapshot without
+    # any anomalies.
+    workers = workers or ANOMALY_WORKERS
+    wanted = set(series_df[SERIES_KEYS].itertuples(index=False, name=None))
+    # split the frame once instead of querying it for every series
+    partitions = {
+        key: data.reset_index(drop=True)
+        for key, data in df.groupby(by=SERIES_KEYS, observed=True, sort=False)
+        if key in wanted
+    }
+    print(f'Scoring {len(partitions)} series with {workers} workers')
+
+    results = []
+    failed = []
+    def collect(done, key, data, error):
+        if error is not None:
+            print(f'Failed to score {" | ".join(key)} : {error}')
+            data = _no_anomalies(partitions[key])
+            failed.append(key)
+        results.append(data)
+        if done % progress_every == 0 or done == len(partitions):
+            print(f'Scored {done}/{len(partitions)} series')
+
+    if workers == 1:
+        for done, (key, data) in enumerate(partitions.items(), 1):
+            collect(done, *_score_series(key, data))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_score_series, key, data): key for key, data in partitions.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    collect(done, *future.result())
+                except Exception as e:
+                    collect(done, futures[future], None, repr(e))
+
+    if failed and len(failed) > max_failed_share * len(partitions):
+        raise RuntimeError(f'{len(failed)} of {len(partitions)} series failed to score')
+    return results, failed
+
+
+@contextlib.contextmanager
+def snapshot_lock(blocking=True):
+    # exclusive lock on cnu_snapshot_lock_path, across processes. Yields whether
+    # it was taken, which is only False when not blocking and another process
+    # holds it. The lock goes with the file when the holder exits or dies.
+    with open(cnu_snapshot_lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def rebuild_snapshot(blocking=True):
+    # scores the anomalies and writes a new snapshot unless the one on disk is
+    # fresh. True if this call rebuilt it. Without blocking it gives up right
+    # away while another process is rebuilding.
+    with snapshot_lock(blocking) as locked:
+        # checked under the lock, another process may just have written it
+        if not locked or is_snapshot_fresh():
+            return False
+        build_snapshot()
+        return True
+
+
 def get_cnu_df_with_anomaly_info():
-    if os.path.exists(cnu_with_anomaly_info_path) \
-        and time.time() - os.path.getmtime(cnu_with_anomaly_info_path) < 3600*24 :
-        cnu_with_anomaly_info = pd.read_csv(cnu_with_anomaly_info_path)
-        cnu_with_anomaly_info['timestamp'] = pd.to_datetime(cnu_with_anomaly_info['timestamp'])
-        return cnu_with_anomaly_info
+    if not is_snapshot_fresh():
+        rebuild_snapshot()
+    return read_snapshot()
 
+
+def build_snapshot():
     df = get_cnu_df_with_grouped_usages()
     significant_svc_ut_df = df[['Service', 'UsageType', 'GrailAccount', 'UsageUnit','Cost']]\
-            .groupby(by=['Service', 'UsageType', 'GrailAccount', 'UsageUnit'])\
+            .groupby(by=['Service', 'UsageType', 'GrailAccount', 'UsageUnit'], observed=True)\
             .sum().reset_index()\
             .query('Cost > 0')\
             .sort_values(by='Cost',ascending=False).copy()
 
+    # only series that are new or whose rows changed since the last snapshot are
+    # re-scored, the rest keep the scores of the previous snapshot
+    state = significant_svc_ut_df[SERIES_KEYS].merge(get_series_state(df), on=SERIES_KEYS)
+    previous_state = read_series_state()
+    changed_svc_ut_df = get_changed_series(state, previous_state)
+    print(f'Re-scoring {changed_svc_ut_df.shape[0]} of {state.shape[0]} series')
+
     df_with_anomalies_info_list = []
-    for index, row in significant_svc_ut_df.iterrows():
-        grail_account = row['GrailAccount']
-        service = row['Service']
-        usage_type = row['UsageType']
-        usage_unit = row['UsageUnit']
-        print(f'{grail_account} | {service} | {usage_type} | {usage_unit}')
-        df_with_anomalies_info_list.append(get_anomalies_using_ma(df,grail_account,service,usage_type,usage_unit))
+    if previous_state is not None:
+        unchanged_keys = state[SERIES_KEYS].merge(changed_svc_ut_df[SERIES_KEYS], how='left', indicator=True)\
+            .query('_merge == "left_only"')[SERIES_KEYS]
+        # the series hash covers (timestamp, Cost) only, so just the scores are
+        # taken over and every other column comes from the rows loaded now
+        previous = read_snapshot(columns=SERIES_KEYS + ['timestamp', 'Anomaly', 'Anomaly_Score'])
+        for column in SERIES_KEYS:
+            previous[column] = previous[column].astype(str)
+        unchanged_df = df.merge(unchanged_keys, on=SERIES_KEYS)[df.columns]
+        df_with_anomalies_info_list.append(
+            unchanged_df.merge(previous, on=SERIES_KEYS + ['timestamp'], how='left')
+            .fillna({'Anomaly': False, 'Anomaly_Score': -1})
+            .astype({'Anomaly': bool}))
+
+    if anomaly_svc.HIST_MA_MODEL == 'hbos':
+        changed_df = df.merge(changed_svc_ut_df[SERIES_KEYS], on=SERIES_KEYS)[df.columns]
+        df_with_anomalies_info_list.append(
+            anomaly_svc.detect_anomalies_hist_ma_batch(changed_df, 'Cost', keys=SERIES_KEYS))
+    else:
+        results, failed = score_series_parallel(df, changed_svc_ut_df)
+        df_with_anomalies_info_list += results
+        # failed series are left out of the state, the next rebuild scores them again
+        failed_df = pd.DataFrame(failed, columns=SERIES_KEYS)
+        state = state.merge(failed_df, on=SERIES_KEYS, how='left', indicator=True)\
+            .query('_merge == "left_only"').drop(columns='_merge')
     cnu_with_anomaly_info = pd.concat(df_with_anomalies_info_list)\
         .sort_values(by=['timestamp','Service','UsageType'])
-    cnu_with_anomaly_info.to_csv(cnu_with_anomaly_info_path,index=False)
-    return cnu_with_anomaly_info
+    write_snapshot(cnu_with_anomaly_info)
+    write_series_state(state)
 
 
-def get_significant_svc_df(startD,endD):
-    df = get_cnu_df_with_anomaly_info()
-    significant_svc_ut_df = df.query('timestamp >= @startD and timestamp < @endD')\
-        [['Service', 'UsageType', 'GrailAccount', 'UsageUnit','Cost','Anomaly']]\
-            .groupby(by=['Service', 'UsageType', 'GrailAccount', 'UsageUnit'])\
-            .sum().reset_index()\
+COST_DIMENSIONS = ['GrailAccount', 'Service', 'UsageType', 'UsageUnit']
+
+
+# days the anomaly counts of a week / month bar are spread over
+ROLLUP_DAYS = {'week': 7, 'month': 31}
+
+
+def build_cost_days(cnu_df):
+    # daily cost rows with their anomaly counts, built once per loaded snapshot
+    # and shared read-only by all sessions. Weeks and months are rolled up from
+    # the rows of a date range with rollup_cost_rows().
+    day = cnu_df[['timestamp'] + COST_DIMENSIONS + ['Cost', 'Anomaly']].reset_index(drop=True)
+    day['AnomalyCount'] = day['Anomaly'].astype('int8')
+    # anomalies are scored per week and repeated on each day, the Saturday row
+    # stands for the whole week
+    day['AnomalyWeek'] = (day['Anomaly'] & (day['timestamp'].dt.dayofweek == 5)).astype('int8')
+
+    return day
+
+
+def rollup_cost_rows(rows, grain):
+    # day rows (already cut to the requested date range) summed per week or
+    # month start, so the bars add up to the range's total. The first and last
+    # period only hold the days inside the range.
+    if grain == 'day':
+        return rows
+    rollup = rows.assign(timestamp=period_start(rows['timestamp'], grain))\
+        [['timestamp'] + COST_DIMENSIONS + ['Cost', 'AnomalyCount']]\
+        .groupby(by=['timestamp'] + COST_DIMENSIONS, observed=True)\
+        .sum().reset_index()
+    rollup['AnomalyCount'] /= ROLLUP_DAYS[grain]
+    return rollup
+
+
+def get_cost_and_anomaly_weeks_by_category(category, fdf):
+    # cost and anomaly week totals per category value from one groupby over the
+    # daily cost rows
+    sum_df = fdf[[category, 'Cost', 'AnomalyWeek']] \
+        .groupby(by=[category], observed=True).sum().reset_index() \
+        .rename(columns={'AnomalyWeek': 'Anomaly'}) \
+        .sort_values(by='Cost', ascending=False)
+    sum_df['Anomaly'] = sum_df['Anomaly'].astype(int)
+    return sum_df
+
+
+def get_svc_usage_summary(df, value_columns=('Cost', 'Anomaly')):
+    # totals per account / service / usage type series of the given rows
+    return df[SERIES_KEYS + list(value_columns)]\
+        .groupby(by=SERIES_KEYS, observed=True)\
+        .sum().reset_index()
+
+
+def get_significant_svc_df(startD, endD, df=None):
+    # df is an already loaded snapshot (or a slice of it), the snapshot is only
+    # read when none is given
+    if df is None:
+        df = get_cnu_df_with_anomaly_info()
+    df = df[(df['timestamp'] >= pd.Timestamp(startD)) & (df['timestamp'] < pd.Timestamp(endD))]
+    significant_svc_ut_df = get_svc_usage_summary(df)\
             .query('Cost > 0')\
-            .sort_values(by='Cost',ascending=False).copy()
+            .sort_values(by='Cost',ascending=False)\
+            [['Service', 'UsageType', 'GrailAccount', 'UsageUnit','Cost','Anomaly']]
 
     return significant_svc_ut_df
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--rebuild']:
+        # run by the app's snapshot refresher, a no-op while another process
+        # is rebuilding
+        rebuild_snapshot(blocking=False)
+        sys.exit()
+
+    # df = benchmark(get_cnu_df)
+    # days = build_cost_days(get_cnu_df_with_anomaly_info())
+    # benchmark(get_cost_and_anomaly_weeks_by_category, 'UsageType', days)
+    # memory_report(get_cnu_df_with_anomaly_info())
     # df = get_cnu_df_with_grouped_usages()
     # print(df.head())
 
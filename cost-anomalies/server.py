@@ -3,36 +3,29 @@ from enum import unique
 from pydoc import classname
 from unicodedata import category
 from shiny import App, ui, render, reactive, req
-import plotnine as gg
-import pandas as pd
 import re
 import datetime
+import time
 from pathlib import Path
 import collections
 import costs_data_svc
 import anomaly_svc
-
-
-# function that creates our UI based on the data
-# we give it
-def create_ui(cnu_df: pd.DataFrame):
+import common_path  # noqa: F401
+import labels
+import plot_cache
+import chart_svc
+import snapshot_svc
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+# function that creates our UI, it does not need the data: the date
+# bounds and choices are filled in by the server once the snapshot is loaded
+def create_ui():
     # calculate the set of unique choices that could be made
     # create our ui object
 
-    max_date = cnu_df['timestamp'].max()
-    min_date = cnu_df['timestamp'].min()
-    start_date = max_date - datetime.timedelta(days=61)
-    significant_svc_ut_df = costs_data_svc.get_significant_svc_df(
-        start_date, max_date)
-
-    svc_costs = significant_svc_ut_df[[
-        'Service', 'Cost'
-    ]].groupby('Service').sum().reset_index()
-    svc_costs['Label'] = svc_costs['Service'] + svc_costs['Cost'].apply(
-        lambda x: f"( {x:,} )")
-    service_dict = dict(
-        list(svc_costs[['Service', 'Label']].itertuples(index=False,
-                                                        name=None)))
+    max_date = datetime.date.today()
 
     app_ui = ui.page_fluid(
         ui.tags.head(
@@ -48,8 +41,6 @@ def create_ui(cnu_df: pd.DataFrame):
                     start=(max_date -
                            datetime.timedelta(days=60)).strftime('%Y-%m-%d'),
                     end=max_date.strftime('%Y-%m-%d'),
-                    min=min_date.strftime('%Y-%m-%d'),
-                    max=max_date.strftime('%Y-%m-%d'),
                     format="mm/dd/yy",
                     separator=" - ",
                 ),
@@ -60,6 +51,8 @@ def create_ui(cnu_df: pd.DataFrame):
                                 "Granularity Month / Day"),
                 ui.input_switch("highlight_anomalies",
                                 "Highlight cost intervals with Anomalies"),
+                ui.input_switch("client_chart",
+                                "Interactive chart (drawn in the browser)"),
             ),
         ),
         ui.row(
@@ -79,6 +72,7 @@ def create_ui(cnu_df: pd.DataFrame):
                     </span>'''),
                         {},
                     ),
+                    ui.output_ui("grail_account_group_more"),
                     ui.hr(),
                     ui.input_text("aws_service_group_filter", "Filter:", ""),
                     ui.input_checkbox_group(
@@ -92,6 +86,7 @@ def create_ui(cnu_df: pd.DataFrame):
                         </span>'''),
                         {},
                     ),
+                    ui.output_ui("aws_service_group_more"),
                 ],
             ),
             ui.column(
@@ -109,12 +104,14 @@ def create_ui(cnu_df: pd.DataFrame):
                     </span>'''),
                     {},
                 ),
+                ui.output_ui("aws_service_feature_group_more"),
             ),
             ui.column(
                 6,
                 # an output container in which to render a plot
                 ui.output_ui("title"),
-                ui.output_plot("out", width="100%", height="800px"),
+                ui.output_image("out", width="100%", height="800px"),
+                ui.output_ui("chart"),
                 # ui.output_text_verbatim("txt"),
                 ui.output_text("txt"),
             )))
@@ -122,12 +119,22 @@ def create_ui(cnu_df: pd.DataFrame):
 
 
 # utility function to draw a scatter plot
-def create_plot(df, highlight_anomalies, monthly=False, fill='UsageType'):
+def get_plot_df(df, highlight_anomalies, fill):
+    # with highlighting on, only usage types that had anomalies are drawn
     if highlight_anomalies and df['AnomalyCount'].sum() > 0:
         usage_types_with_anomalies = df[['UsageType', 'AnomalyCount']] \
-            .groupby('UsageType').sum().reset_index() \
+            .groupby('UsageType', observed=True).sum().reset_index() \
             .query('AnomalyCount > 0')['UsageType'].unique().tolist()
         df = df.query('UsageType in @usage_types_with_anomalies')
+    # bars of the top fill values by cost, the rest are stacked as 'Other'
+    return chart_svc.top_n_with_other(df, fill, 'Cost',
+                                      by=['timestamp', 'GrailAccount'],
+                                      sums=['Cost', 'AnomalyCount'])
+
+
+def create_plot(df, highlight_anomalies, resolution='day', fill='UsageType'):
+    import plotnine as gg  # slow to import, loaded with the first plot
+    df = get_plot_df(df, highlight_anomalies, fill)
     plot = (gg.ggplot(
         df, gg.aes(x='timestamp', y='Cost', fill=fill, alpha='AnomalyCount')) +
             gg.scale_alpha_continuous(range=(0.2, 1))
@@ -135,143 +142,197 @@ def create_plot(df, highlight_anomalies, monthly=False, fill='UsageType'):
                 df, gg.aes(x='timestamp', y='Cost', fill=fill)))
     # plot = ( gg.ggplot(df, gg.aes(x = 'timestamp', y='Cost',
     #     fill='AnomalyCount' if highlight_anomalies else 'UsageType')))
+    grain = chart_svc.RESOLUTION_TITLES[resolution]
     plot = (plot + gg.geom_bar(stat="identity") +
             gg.facet_grid("GrailAccount ~ .", scales="free", space="free") +
             gg.theme(axis_text_x=gg.element_text(angle=30, hjust=1)) +
-            gg.labs(title=f"{'Monthly' if monthly else 'Daily'} Costs Plot",
+            gg.labs(title=f"{grain} Costs Plot",
                     x="Date",
-                    y=f"{'Monthly' if monthly else 'Daily'} Cost USD"))
+                    y=f"{grain} Cost USD"))
     return plot.draw()
 
 
-def get_cost_and_anomaly_weeks_by_category(category, fdf):
-    cost_sums = fdf \
-        [[category, 'timestamp', 'Cost']] \
-        .groupby(by=[category]).sum().reset_index()
-    anomaly_sums = fdf[fdf['timestamp'].apply(lambda d: d.day_name()) == 'Saturday'] \
-        [[category, 'timestamp', 'Anomaly']] \
-        .groupby(by=[category]).sum().reset_index()
-    sum_df = cost_sums.set_index([category]) \
-        .join(anomaly_sums.set_index([category]), how='left') \
-        .reset_index() \
-        .sort_values(by='Cost', ascending=False)
-    sum_df["Anomaly"] = sum_df["Anomaly"].fillna(0).astype(int)
-    return sum_df
-
-
 def get_cat_sizes_dict(category, fdf, key_filter):
-    cat_sizes = get_cost_and_anomaly_weeks_by_category(category, fdf)
-
-    cat_sizes['Label'] = cat_sizes.apply(lambda row: ui.HTML(f'''<span> 
-                <span class="category-name">{row[category]}</span>  
-                <span class="badge alert-info">$ {row["Cost"]:,}</span>
-                |<span class="badge alert-warning text-danger">{row["Anomaly"]}</span>
-            </span>'''),
-                                         axis=1)
-    cat_dict = dict(cat_sizes[[category, 'Label']].itertuples(index=False,
-                                                              name=None))
+    cat_sizes = costs_data_svc.get_cost_and_anomaly_weeks_by_category(category, fdf)
+
     if key_filter and key_filter.strip() != '':
         try:
             rx = re.compile(key_filter)
-            cat_dict = {k: v for k, v in cat_dict.items() if rx.search(k)}
+            cat_sizes = cat_sizes[cat_sizes[category].astype(str).map(lambda k: bool(rx.search(k)))]
         except:
             pass
+    cat_sizes = cat_sizes.assign(Label=labels.render_labels(cat_sizes[category], [
+        ('<span class="badge alert-info">$ {:,}</span>', cat_sizes['Cost']),
+        ('|<span class="badge alert-warning text-danger">{}</span>', cat_sizes['Anomaly']),
+    ]))
+    cat_dict = dict(cat_sizes[[category, 'Label']].itertuples(index=False,
+                                                              name=None))
     return cat_dict, cat_sizes
 
 
+# checkbox groups of the filter cascade, in dependency order:
+# (category, checkbox group id, key filter text input id)
+FILTER_CASCADE = [
+    ('GrailAccount', 'grail_account_group', None),
+    ('Service', 'aws_service_group', 'aws_service_group_filter'),
+    ('UsageType', 'aws_service_feature_group', 'aws_service_feature_group_filter'),
+]
+# quiet time after the last filter input change before the cascade is recomputed
+FILTER_DEBOUNCE_SECS = 0.3
+# pixel size the cost plot is rendered at until the browser reports the size
+# of its output box
+PLOT_WIDTH = 1200
+PLOT_HEIGHT = 800
+
+
+def debounce(delay_secs):
+    # reactive.Calc that only changes once its inputs have been quiet for
+    # delay_secs, so a burst of input events is evaluated once
+    def wrapper(f):
+        deadline = reactive.Value(None)
+        trigger = reactive.Value(0)
+
+        @reactive.Calc
+        def pending():
+            return f()
+
+        @reactive.Effect(priority=102)
+        def _prime():
+            try:
+                pending()
+            finally:
+                deadline.set(time.time() + delay_secs)
+
+        @reactive.Effect(priority=101)
+        def _timer():
+            when = deadline()
+            if when is None:
+                return
+            wait = when - time.time()
+            if wait > 0:
+                reactive.invalidate_later(wait)
+                return
+            with reactive.isolate():
+                deadline.set(None)
+                trigger.set(trigger() + 1)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_none=False, ignore_init=True)
+        def debounced():
+            return pending()
+
+        return debounced
+
+    return wrapper
+
+
+def get_filter_state(snapshot, date_range, selections, key_filters):
+    # all checkbox choices and the title stats from the snapshot's per series
+    # summary of the date range, each cascade stage narrows the previous
+    # stage's rows by its selection
+    fdf = snapshot.usage_summary(*date_range)
+    state = {'date_range': date_range}
+    for category, _, filter_id in FILTER_CASCADE:
+        cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf, key_filters.get(category))
+        old_selected = selections.get(category, ())
+        selected = list(old_selected) or list(cat_dict.keys())[:1]
+        hint = 'narrow the list with Filter' if filter_id else None
+        choices, note = labels.limit_choices(cat_dict, selected, hint=hint)
+        state[category] = (choices, selected, list(old_selected) != selected, note)
+        fdf = fdf[fdf[category].isin(selected).values]
+    state['rows'] = fdf.shape[0]
+    state['Cost'] = fdf['Cost'].sum()
+    state['Anomaly'] = int(fdf['AnomalyWeek'].sum())
+    return state
+
+
 # wrapper function for the server, allows the data
 # to be passed in
-def create_server(cnu_df):
-
-    def f(input, output, session):
-        # --
-        my_session_cache = {"selections": collections.defaultdict(set)}
-        my_session_cache['df_day'] = cnu_df
+# rendered plot images, shared by all sessions
+plots = plot_cache.PlotCache()
 
-        cnu_df['AnomalyCount'] = cnu_df['Anomaly'] + 0
 
-        cnu_df['Month'] = pd.to_datetime(
-            cnu_df['timestamp'].apply(lambda x: x.strftime('%Y-%m-01')))
+def create_server(refresher):
+    # the current snapshot (daily cost rows and their index) is shared by
+    # all sessions and never modified, the refresher swaps in new ones
 
-        df_month = cnu_df[['Month', 'Service', 'UsageType', 'UsageUnit', 'GrailAccount', 'Cost', 'AnomalyCount']] \
-            .groupby(by=['Month', 'Service', 'UsageType', 'UsageUnit', 'GrailAccount']) \
-            .sum().reset_index().copy()
-        df_month['timestamp'] = df_month['Month']
-        df_month['AnomalyCount'] /= 31
-        my_session_cache['df_month'] = df_month
+    def f(input, output, session):
+        # --
+        my_session_cache = {"selections": collections.defaultdict(set), "pushed": {}}
 
         # --
+        @reactive.poll(lambda: refresher.current and refresher.current.version,
+                       snapshot_svc.SNAPSHOT_POLL_SECS)
+        def snapshot():
+            # everything below depends on this, so a swapped in snapshot
+            # recomputes the filters, title and plot of open sessions. None
+            # while the first snapshot is still loading.
+            return refresher.current
+
         @reactive.Effect
-        @reactive.event(input.date_range)
-        def _a0_account():
-            startD, endD = input.date_range()
-            old_selected = input.grail_account_group()
-            df_query = "timestamp >= @startD and timestamp < @endD"
-            fdf = cnu_df.query(df_query)
-            category = 'GrailAccount'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf, None)
-            choices = cat_dict
-            selected = old_selected or list(cat_dict.keys())[:1]
-            ui.update_checkbox_group(
-                "grail_account_group",
-                choices=choices,
-                selected=selected,
-            )
+        def _snapshot_updated():
+            current = snapshot()
+            if current is None or my_session_cache.get('version') == current.version:
+                return
+            max_date = current.days['timestamp'].max()
+            if 'version' not in my_session_cache:
+                # first snapshot of this session, the page was served with
+                # placeholder dates
+                min_date = current.days['timestamp'].min()
+                ui.update_date_range(
+                    "date_range",
+                    start=(max_date - datetime.timedelta(days=60)).strftime('%Y-%m-%d'),
+                    end=max_date.strftime('%Y-%m-%d'),
+                    min=min_date.strftime('%Y-%m-%d'),
+                    max=max_date.strftime('%Y-%m-%d'))
+            else:
+                ui.update_date_range("date_range", max=max_date.strftime('%Y-%m-%d'))
+                ui.notification_show("Cost data was refreshed.", duration=5)
+            my_session_cache['version'] = current.version
 
         # --
-        @reactive.Effect
-        @reactive.event(input.date_range, input.grail_account_group,
-                        input.aws_service_group_filter)
-        def _a0_service():
-
-            startD, endD = input.date_range()
-            old_selected = input.aws_service_group()
-            grail_account = input.grail_account_group()
-            key_filter = input.aws_service_group_filter()
-            df_query = "timestamp >= @startD and timestamp < @endD and GrailAccount in @grail_account"
-            fdf = cnu_df.query(df_query)
-
-            category = 'Service'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf, key_filter)
-            choices = cat_dict
-            selected = old_selected or list(cat_dict.keys())[:1]
-
-            ui.update_checkbox_group(
-                "aws_service_group",
-                choices=choices,
-                selected=selected,
-            )
+        @debounce(FILTER_DEBOUNCE_SECS)
+        def filter_inputs():
+            return (input.date_range(),
+                    {category: tuple(input[group_id]())
+                     for category, group_id, _ in FILTER_CASCADE},
+                    {category: input[filter_id]()
+                     for category, _, filter_id in FILTER_CASCADE if filter_id})
+
+        @reactive.Calc
+        def filter_state():
+            date_range, selections, key_filters = filter_inputs()
+            return get_filter_state(req(snapshot()), date_range, selections,
+                                    key_filters)
 
         # --
         @reactive.Effect
-        # @reactive.event(input.date_range,
-        #                 input.grail_account_group,
-        #                 input.aws_service_group_filter,
-        #                 input.aws_service_feature_group_filter)
-        def _a0_usagetype():
-            aws_services = input.aws_service_group()
-            startD, endD = input.date_range()
-            grail_account = input.grail_account_group()
-
-            old_selected = input.aws_service_feature_group()
-            key_filter = input.aws_service_feature_group_filter()
-
-            df_query = "timestamp >= @startD and timestamp < @endD" + \
-                       " and GrailAccount in @grail_account" + \
-                       " and Service in @aws_services"
-
-            fdf = cnu_df.query(df_query)
-            category = 'UsageType'
-
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf, key_filter)
-            choices = cat_dict
-            selected = old_selected or list(cat_dict.keys())[:1]
-
-            ui.update_checkbox_group(
-                "aws_service_feature_group",
-                choices=choices,
-                selected=selected,
-            )
+        def _update_filters():
+            # push all checkbox groups in one flush, skipping the ones whose
+            # choices did not change since the last push and whose selection
+            # already matches the browser (e.g. the echo of our own update)
+            state = filter_state()
+            pushed = my_session_cache['pushed']
+            for category, group_id, _ in FILTER_CASCADE:
+                choices, selected, selection_changed, _ = state[category]
+                key = tuple((k, str(v)) for k, v in choices.items())
+                if pushed.get(category) == key and not selection_changed:
+                    continue
+                pushed[category] = key
+                ui.update_checkbox_group(
+                    group_id,
+                    choices=choices,
+                    selected=selected,
+                )
+
+        def more_choices_output(category, group_id):
+            @output(id=f"{group_id}_more")
+            @render.ui
+            def _():
+                return labels.more_choices_ui(filter_state()[category][3])
+
+        for category, group_id, _ in FILTER_CASCADE:
+            more_choices_output(category, group_id)
 
         # @reactive.Effect
         # def _z():
@@ -389,39 +450,21 @@ def create_server(cnu_df):
 
         @output
         @render.ui
-        @reactive.event(input.aws_service_group,
-                        input.aws_service_feature_group,
-                        input.grail_account_group)
         def title():
-            granularity_month = input.granularity_month()
-            highlight_anomalies = input.highlight_anomalies()
-            startD, endD = input.date_range()
-            aws_services = input.aws_service_group()
-            grail_account = input.grail_account_group()
-            aws_service_feature = input.aws_service_feature_group()
+            if snapshot() is None:
+                return ui.tags.div(
+                    ui.tags.h5("Loading cost data ..."),
+                    class_= "title-area"
+                )
+            state = filter_state()
+            startD, endD = state['date_range']
             selection = [f"Dates in range {startD} - {endD}"]
-            df_query_toks = ["timestamp >= @startD and timestamp < @endD"]
-            if grail_account != '':
-                df_query_toks.append("GrailAccount in @grail_account")
-                selection.append(f"GrailAccount in {list(grail_account)}")
-                category = 'GrailAccount'
-            if aws_services != '':
-                df_query_toks.append("Service in @aws_services")
-                selection.append(f"Service in {list(aws_services)}")
-                category = 'Service'
-            if aws_service_feature != '':
-                df_query_toks.append("UsageType in @aws_service_feature")
-                selection.append(f"UsageType in {list(aws_service_feature)}")
-                category = 'UsageType'
-
-            df_query = " and ".join(df_query_toks)
-            sub = my_session_cache['df_day'].query(
-                df_query).copy()  # use it to create a subset
-            if not sub.shape[0]: return
+            for category, _, _ in FILTER_CASCADE:
+                selection.append(f"{category} in {state[category][1]}")
+            if not state['rows']: return
 
-            cat_sizes = get_cost_and_anomaly_weeks_by_category(category, sub)
-            total_amount = cat_sizes['Cost'].sum()
-            anomaly_count = cat_sizes['Anomaly'].sum()
+            total_amount = state['Cost']
+            anomaly_count = state['Anomaly']
             # return f"query : {df_query}<br/>Blended Cost (without discount): {total_amount} USD"
             return ui.tags.div(
                 ui.tags.p(f"[{' AND '.join(selection)}].",class_="code", ),
@@ -446,51 +489,105 @@ def create_server(cnu_df):
 
         @output(id="out"
                 )  # decorator to link this function to the "out" id in the UI
-        @render.plot  # a decorator to indicate we want the plot renderer
-        @reactive.event(input.aws_service_feature_group,
-                        input.grail_account_group)        
+        @render.image(delete_file=True)
         def plot():
+            if input.client_chart(): return
             granularity_month = input.granularity_month()
             highlight_anomalies = input.highlight_anomalies()
 
-            startD, endD = input.date_range()
-            aws_services = input.aws_service_group()
-            grail_account = input.grail_account_group()
-            aws_service_feature = input.aws_service_feature_group()
-
-            df_query_toks = ["timestamp >= @startD and timestamp < @endD"]
-            if grail_account != '':
-                df_query_toks.append("GrailAccount in @grail_account")
-            if aws_services != '':
-                df_query_toks.append("Service in @aws_services")
-            if aws_service_feature != '':
-                df_query_toks.append("UsageType in @aws_service_feature")
+            state = filter_state()
+            startD, endD = state['date_range']
+            grail_account = state['GrailAccount'][1]
+            aws_services = state['Service'][1]
+            aws_service_feature = state['UsageType'][1]
+
+            current = req(snapshot())
+            width, height, pixel_ratio = plot_cache.client_size(session, "out", PLOT_WIDTH,
+                                                                PLOT_HEIGHT)
+            # long ranges are drawn per week / month to bound the bar count
+            resolution = chart_svc.pick_resolution(
+                startD, endD, finest='month' if granularity_month else 'day')
+
+            def render_plot():
+                sub = current.index.slice((startD, endD),
+                                          accounts=grail_account,
+                                          services=aws_services,
+                                          usage_types=aws_service_feature)
+                sub = costs_data_svc.rollup_cost_rows(sub, resolution)
+
+                if not sub.shape[0]: return
+
+                fillColor = 'UsageType' if len(aws_services) == 1 else 'Service'
+
+                plot = create_plot(sub,
+                                   highlight_anomalies,
+                                   resolution,
+                                   fill=fillColor)  # create our plot
+                return plot_cache.figure_png(plot, width, height, pixel_ratio)
+
+            key = plot_cache.plot_key(current.version, startD, endD, grail_account,
+                                      aws_services, aws_service_feature,
+                                      resolution, highlight_anomalies,
+                                      width, height, pixel_ratio)
+            png = plots.get(key, render_plot)
+            if png is None: return
+            return plot_cache.image_data(png, width, height)  # and return it
 
-            df_query = " and ".join(df_query_toks)
-            sub = my_session_cache['df_day'].query(
-                df_query).copy()  # use it to create a subset
-
-            fdf = my_session_cache[
-                'df_month'] if granularity_month else my_session_cache['df_day']
-            sub = fdf.query(df_query).copy()  # use it to create a subset
+        @output
+        @render.ui
+        def chart():
+            # same chart as plot, drawn by the browser from the aggregated rows
+            if not input.client_chart(): return
+            granularity_month = input.granularity_month()
+            highlight_anomalies = input.highlight_anomalies()
 
+            state = filter_state()
+            resolution = chart_svc.pick_resolution(
+                *state['date_range'], finest='month' if granularity_month else 'day')
+            sub = req(snapshot()).index.slice(state['date_range'],
+                                              accounts=state['GrailAccount'][1],
+                                              services=state['Service'][1],
+                                              usage_types=state['UsageType'][1])
+            sub = costs_data_svc.rollup_cost_rows(sub, resolution)
             if not sub.shape[0]: return
 
-            fillColor = 'UsageType' if len(aws_services) == 1 else 'Service'
-
-            plot = create_plot(sub,
-                               highlight_anomalies,
-                               granularity_month,
-                               fill=fillColor)  # create our plot
-            return plot  # and return it
+            grain = chart_svc.RESOLUTION_TITLES[resolution]
+            fill = 'UsageType' if len(state['Service'][1]) == 1 else 'Service'
+            spec = chart_svc.stacked_bar_spec(
+                get_plot_df(sub, highlight_anomalies, fill),
+                x='timestamp', y='Cost',
+                fill=fill,
+                facet='GrailAccount',
+                alpha='AnomalyCount' if highlight_anomalies else None,
+                title=f"{grain} Costs Plot", x_title="Date",
+                y_title=f"{grain} Cost USD")
+            return chart_svc.chart_ui("cost_chart", spec)
 
     return f
 
 
-cnu_df = costs_data_svc.get_cnu_df_with_anomaly_info()
+# the snapshot is loaded by the refresher thread, the page is served (with
+# loading placeholders) before it is ready
+refresher = snapshot_svc.SnapshotRefresher()
+refresher.start()
 
-frontend = create_ui(cnu_df)
-server = create_server(cnu_df)
+frontend = create_ui()
+server = create_server(refresher)
 
 www_dir = Path(__file__).parent / "www"
 app = App(frontend, server, static_assets=www_dir)
+
+
+def healthz(request):
+    # healthy as soon as the app serves pages, also while the data is loading,
+    # but not while loading the first snapshot fails.
+    # The plot cache counters are reported here instead of logged per render.
+    if refresher.current is None and refresher.error:
+        return JSONResponse({'status': 'error', 'data': 'failed', 'error': refresher.error},
+                            status_code=503)
+    return JSONResponse({'status': 'ok',
+                         'data': 'loading' if refresher.current is None else 'ready',
+                         'plot_cache': plots.stats()})
+
+
+app.starlette_app.router.routes.insert(0, Route('/healthz', healthz))
@@ -4,37 +4,14 @@ import plotnine as gg
 import pandas as pd
 from datetime import date
 
-import sqlalchemy
+import access_metrics_svc
 
 
-def get_mysql_engine():
-    database_username = 'trimble'
-    database_password = 'trimble'
-    db_url = sqlalchemy.engine.url.URL.create(
-        drivername="mysql+mysqlconnector",
-        username=database_username,
-        password=database_password,
-        host='127.0.0.1',
-        port=3316,
-        database='trimble',
-        query={"ssl_ca": '/Users/avashisth/.ssh/rds-combined-ca-bundle.pem'},
-    )
-    engine = sqlalchemy.create_engine(db_url, pool_recycle=1, pool_timeout=57600)
-    return engine
-
 def get_df():
-    query = """
-        SELECT 
-            CONCAT(CallerType,'/',CallerName) Caller ,
-            Bucket, 
-            GrailAccount,
-            SUM(pbam.AccessCount) CallCount  
-        FROM PIPELINE_BUCKET_ACCESS_METRICS pbam 
-        GROUP BY CallerType,CallerName,AccessType,Bucket,GrailAccount
-        ORDER BY CallCount DESC
-    """
-    df = pd.read_sql(query,get_mysql_engine())
-    return df
+    # access counts per caller / bucket / account, from the shared pooled
+    # engine and served from its result cache while fresh
+    return access_metrics_svc.get_access_counts()
+
 
 def get_cnu_df():
     BASE_PATH='/Users/avashisth/workspace/aws-util/cost-explorer/data'
@@ -101,9 +78,9 @@ def create_plot(df):
    )
   return plot.draw()
 
-# wrapper function for the server, allows the data
-# to be passed in
-def create_server(df):
+# wrapper function for the server, the rows of each plot
+# are queried (and cached) by access_metrics_svc
+def create_server():
   def f(input, output, session):
     @output
     @render.text
@@ -115,17 +92,18 @@ def create_server(df):
     def plot():
       grail_account = list(input.grail_account()) # access the input value bound to the id "select"
       pipeline_stage = input.pipeline_stage()
-      df_query = f"GrailAccount in {tuple(grail_account)} and Bucket.str.contains('{pipeline_stage}')"
-      print(df_query)
-      sub = df.query(df_query) # use it to create a subset
+      # filtered in the database, bound parameters work for any number of accounts
+      sub = access_metrics_svc.get_bucket_access_summary(grail_account, pipeline_stage)
+      if sub.empty: return
       plot = create_plot(sub) # create our plot
       return plot # and return it
   return f
 
-s3_info_df = get_df()
+# only the account choices are read at startup
+accounts_df = access_metrics_svc.get_grail_accounts()
 
-frontend = create_ui(s3_info_df)
+frontend = create_ui(accounts_df)
 
-server = create_server(s3_info_df)
+server = create_server()
 
 app = App(frontend, server)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import functools
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import common_path  # noqa: F401
+import costs_data_svc
+import plot_cache
+from cost_index import CostIndex
+
+
+# how often the refresher checks whether the snapshot on disk is stale or was
+# rewritten by another process, and the wait after a failed refresh
+SNAPSHOT_CHECK_SECS = int(os.environ.get('SNAPSHOT_CHECK_SECS', 30))
+SNAPSHOT_RETRY_SECS = int(os.environ.get('SNAPSHOT_RETRY_SECS', 600))
+# how often open sessions look for a new (or the first) snapshot
+SNAPSHOT_POLL_SECS = 2
+# date ranges whose series summary is kept per snapshot
+SUMMARY_CACHE_SIZE = 64
+
+
+class CostSnapshot:
+    # One loaded anomaly snapshot and everything derived from it. It is built
+    # off to the side and never modified afterwards, so sessions can keep using
+    # the one they hold while a newer one is swapped in.
+
+    def __init__(self, cnu_df, mtime=None):
+        self.mtime = mtime
+        self.days = costs_data_svc.build_cost_days(cnu_df)
+        self.index = CostIndex(self.days)
+        # a rebuild may only change the anomaly flags (a new model or snapshot
+        # version), the file's mtime tells those apart
+        self.version = (mtime,) + plot_cache.data_version(self.days, 'Cost', 'AnomalyCount')
+        self._summaries = functools.lru_cache(maxsize=SUMMARY_CACHE_SIZE)(self._summarize)
+
+    def _summarize(self, startD, endD):
+        return costs_data_svc.get_svc_usage_summary(
+            self.index.slice((startD, endD)), ('Cost', 'Anomaly', 'AnomalyWeek'))
+
+    def usage_summary(self, startD, endD):
+        # Cost, Anomaly and AnomalyWeek totals per series with startD <= timestamp
+        # < endD, memoized per range. Shared, callers must not modify it.
+        return self._summaries(pd.Timestamp(startD), pd.Timestamp(endD))
+
+
+def snapshot_mtime():
+    path = costs_data_svc.cnu_with_anomaly_info_path
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def rebuild_snapshot():
+    # in a child process, scoring holds the GIL for minutes and would stall the
+    # sessions served by this one. Returns at once while another app worker
+    # rebuilds, see costs_data_svc.rebuild_snapshot().
+    subprocess.run([sys.executable, costs_data_svc.__file__, '--rebuild'], check=True)
+
+
+class SnapshotRefresher:
+    # Holds the current CostSnapshot and reloads it on a background thread when
+    # the file on disk changes. Of all the app's worker processes, only the one
+    # holding the snapshot lock rebuilds a stale snapshot, the others pick it
+    # up by its mtime. An expired snapshot is served until then. The swap is a
+    # single attribute assignment, readers never wait for it.
+
+    def __init__(self, check_interval=SNAPSHOT_CHECK_SECS, retry_interval=SNAPSHOT_RETRY_SECS):
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.current = None
+        # repr of the last failed refresh, None once one succeeds
+        self.error = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def refresh(self):
+        # rebuild the snapshot if it expired and load it if it changed on disk.
+        # Without a current one, the file on disk is loaded first when it has
+        # the current layout, even if it expired, so sessions are served (and
+        # keep being served should the rebuild fail) while it is rebuilt.
+        with self.lock:
+            loaded = False
+            if self.current is None \
+                    and costs_data_svc.get_snapshot_version() == costs_data_svc.SNAPSHOT_VERSION:
+                loaded = self.load()
+            if not costs_data_svc.is_snapshot_fresh():
+                rebuild_snapshot()
+            return self.load() or loaded
+
+    def load(self):
+        # the snapshot on disk, unless the current one has its mtime (or there
+        # is none yet, while another worker builds the first one)
+        mtime = snapshot_mtime()
+        current = self.current
+        if mtime is None or (current is not None and mtime == current.mtime):
+            return False
+        start = time.time()
+        snapshot = CostSnapshot(costs_data_svc.read_snapshot(), mtime)
+        self.current = snapshot
+        print(f'Snapshot {snapshot.version} loaded in {time.time() - start:.1f}s')
+        return True
+
+    def _run(self):
+        # the first pass loads the initial snapshot
+        while True:
+            try:
+                self.refresh()
+                self.error = None
+                wait = self.check_interval
+            except Exception as e:
+                # keep serving the snapshot we have, try again later
+                self.error = repr(e)
+                print(f'Snapshot refresh failed: {e!r}')
+                wait = self.retry_interval
+            time.sleep(wait)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='snapshot-refresher',
+                                           daemon=True)
+            self.thread.start()
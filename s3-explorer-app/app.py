@@ -2,18 +2,23 @@
 from nis import cat
 from unicodedata import category
 from shiny import App, ui, render, reactive, req
-import plotnine as gg
-import pandas as pd
 import datetime
+import threading
+import time
+from starlette.responses import JSONResponse
+from starlette.routing import Route
 import data_svc
+import common_path  # noqa: F401
+import labels
+import plot_cache
+import chart_svc
 
 
-# function that creates our UI based on the data
-# we give it
-def create_ui(df: pd.DataFrame):
+# function that creates our UI, it does not need the data: the date
+# bounds and choices are filled in by the server once the data is loaded
+def create_ui():
 
-    max_date = df['timestamp'].max()
-    min_date = df['timestamp'].min()
+    max_date = datetime.date.today()
     start_date = max_date - datetime.timedelta(days=61)
 
     # calculate the set of unique choices that could be made
@@ -30,8 +35,6 @@ def create_ui(df: pd.DataFrame):
                     "Date range:",
                     start=start_date.strftime('%Y-%m-%d'),
                     end=max_date.strftime('%Y-%m-%d'),
-                    min=min_date.strftime('%Y-%m-%d'),
-                    max=max_date.strftime('%Y-%m-%d'),
                     format="mm/dd/yy",
                     separator=" - ",
                 ),
@@ -40,13 +43,19 @@ def create_ui(df: pd.DataFrame):
                 3,
                 ui.input_text("bucket_name_filter", "Bucket Filter:", ""),
             ),
+            ui.column(
+                3,
+                ui.input_switch("client_chart",
+                                "Interactive chart (drawn in the browser)"),
+            ),
         ),
         ui.row(
             ui.column(2),
             ui.column(
                 10,
                 # an output container in which to render a plot
-                ui.output_plot("out", width="100%", height="400px"),
+                ui.output_image("out", width="100%", height="400px"),
+                ui.output_ui("chart"),
                 ui.output_text_verbatim("txt"),
                 ui.row(
                     ui.column(
@@ -56,6 +65,7 @@ def create_ui(df: pd.DataFrame):
                             "Bucket Use by Pipeline Stage",
                             {},
                         ),
+                        ui.output_ui("pipeline_stage_group_more"),
                     ),
                     ui.column(
                         3,
@@ -64,6 +74,7 @@ def create_ui(df: pd.DataFrame):
                             "Bucket Use by Grail Account",
                             {},
                         ),
+                        ui.output_ui("grail_account_group_more"),
                     ),
                     ui.column(
                         3,
@@ -72,6 +83,7 @@ def create_ui(df: pd.DataFrame):
                             "Buckets",
                             {},
                         ),
+                        ui.output_ui("bucket_group_more"),
                     ),
                     ui.column(
                         3,
@@ -80,6 +92,7 @@ def create_ui(df: pd.DataFrame):
                             "S3 Storage Tier",
                             {},
                         ),
+                        ui.output_ui("storage_tier_group_more"),
                     ),
                 ),
                 # ui.output_text("txt"),
@@ -87,11 +100,30 @@ def create_ui(df: pd.DataFrame):
     return app_ui
 
 
+# checkbox groups whose choices are cut at labels.MAX_CHOICES
+CHECKBOX_GROUPS = ['pipeline_stage_group', 'grail_account_group', 'bucket_group',
+                   'storage_tier_group']
+# how often sessions check whether the data has been loaded
+S3_DATA_POLL_SECS = 1
+# wait before loading the data again after a failed attempt
+S3_DATA_RETRY_SECS = 60
+# pixel size the plots are rendered at until the browser reports the size of
+# their output box
+PLOT_WIDTH = 1200
+PLOT_HEIGHT = 400
+
+
+def get_plot_df(df, fill):
+    # bars of the top fill values by bytes, the rest are stacked as 'Other'
+    xdf = chart_svc.top_n_with_other(df, fill, 'Bytes')
+    xdf['PetaBytes'] = (xdf['Bytes'] * 1e-15).round(2)
+    return xdf
+
+
 # utility function to draw a scatter plot
 def create_plot(df):
-    xdf = df[['timestamp', 'BucketName', 'Bytes'
-              ]].groupby(by=['timestamp', 'BucketName']).sum().reset_index()
-    xdf['PetaBytes'] = (xdf['Bytes'] * 1e-15).round(2)
+    import plotnine as gg  # slow to import, loaded with the first plot
+    xdf = get_plot_df(df, 'BucketName')
     plot = (gg.ggplot(
         xdf, gg.aes(x='timestamp', y='PetaBytes', fill="BucketName")) +
             gg.geom_bar(stat="identity") +
@@ -100,9 +132,8 @@ def create_plot(df):
 
 
 def create_bucket_plot(df):
-    xdf = df[['timestamp', 'StorageType', 'Bytes'
-              ]].groupby(by=['timestamp', 'StorageType']).sum().reset_index()
-    xdf['PetaBytes'] = (xdf['Bytes'] * 1e-15).round(2)
+    import plotnine as gg  # slow to import, loaded with the first plot
+    xdf = get_plot_df(df, 'StorageType')
     print(xdf.head())
     plot = (gg.ggplot(
         xdf, gg.aes(x='timestamp', y='PetaBytes', fill="StorageType")) +
@@ -111,24 +142,40 @@ def create_bucket_plot(df):
     return plot.draw()
 
 
+def select_plot_rows(cube, startD, endD, grail_account, pipeline_stage,
+                     storage_tiers, bucket_list):
+    # rows to plot and the column splitting the bars: buckets of the selected
+    # accounts and stages, or storage tiers once buckets are picked. Long
+    # ranges are rolled up per week / month to bound the bar count.
+    resolution = chart_svc.pick_resolution(startD, endD)
+    storage_tiers = storage_tiers if len(storage_tiers) > 0 else None
+    if len(bucket_list) == 0:
+      sub = cube.slice_at(resolution, (startD, endD), GrailAccount=grail_account,
+                          PipelineBucketType=pipeline_stage, StorageType=storage_tiers)
+      fill = 'BucketName'
+    else:
+      sub = cube.slice_at(resolution, (startD, endD), BucketName=bucket_list,
+                          StorageType=storage_tiers)
+      fill = 'StorageType'
+    return sub, fill
+
+
 # wrapper function for the server, allows the data
 # to be passed in
 
-def get_cat_sizes_dict(category, fdf, session_cache):
+def get_cat_sizes_dict(category, sizes, session_cache):
+    # sizes: mean daily bytes per value of category, from S3Cube.category_sizes
     cat_dict_old = session_cache.get(category, {})
     session_cache[category] = {}
     cat_dict = session_cache[category]
 
-    cat_sizes = fdf[[category,'timestamp','Bytes']]\
-      .groupby(by=[category,'timestamp']).sum().reset_index()\
-      .groupby(by=[category]).mean(numeric_only=True).reset_index().sort_values(by='Bytes',ascending=False)
+    cat_sizes = sizes.reset_index()
     cat_sizes['PBytes'] = (cat_sizes["Bytes"] * 1e-15).round(2)
     # cat_sizes['Label'] = cat_sizes.apply(
     #     lambda row: f'{row[category]} ({row["PBytes"]:,}) ', axis=1)
-    cat_sizes['Label'] = cat_sizes.apply(lambda row: ui.HTML(
-        f'<span> <span class="category-name">{row[category]}</span> <span class="badge alert-info">{row["PBytes"]} PB</span></span>'
-    ),
-                                         axis=1)
+    cat_sizes['Label'] = labels.render_labels(cat_sizes[category], [
+        ('<span class="badge alert-info">{} PB</span>', cat_sizes['PBytes']),
+    ])
 
     for k, l in list(cat_sizes[[category, 'Label']].itertuples(index=False,
                                                                name=None)):
@@ -136,24 +183,64 @@ def get_cat_sizes_dict(category, fdf, session_cache):
     return cat_dict, cat_sizes
 
 
-def create_server(df):
+# rendered plot images, shared by all sessions
+plots = plot_cache.PlotCache()
+
+
+def create_server(s3_data):
 
     def f(input, output, session):
         session_cache = {}
+        # left out choices note per checkbox group, see labels.limit_choices
+        more_notes = {group_id: reactive.Value(None) for group_id in CHECKBOX_GROUPS}
+
+        def more_choices_output(group_id):
+            @output(id=f"{group_id}_more")
+            @render.ui
+            def _():
+                return labels.more_choices_ui(more_notes[group_id]())
+
+        for group_id in CHECKBOX_GROUPS:
+            more_choices_output(group_id)
+
+        @reactive.poll(lambda: (s3_data['version'], s3_data['error']), S3_DATA_POLL_SECS)
+        def s3_cube():
+            # None until the loader thread has finished
+            return s3_data['cube']
+
+        def loaded_cube():
+            # stops the calling effect / output until the data is there
+            cube = s3_cube()
+            req(cube is not None)
+            return cube
+
+        @reactive.Effect
+        def _a00():
+            # the page was served with placeholder dates
+            cube = loaded_cube()
+            max_date = cube.df['timestamp'].max()
+            min_date = cube.df['timestamp'].min()
+            ui.update_date_range(
+                "date_range",
+                start=(max_date - datetime.timedelta(days=61)).strftime('%Y-%m-%d'),
+                end=max_date.strftime('%Y-%m-%d'),
+                min=min_date.strftime('%Y-%m-%d'),
+                max=max_date.strftime('%Y-%m-%d'),
+            )
 
         @reactive.Effect
         def _a0a():
-            # df = df[['timestamp', 'Bytes', 'BucketName', 'StorageType','AWSAccount', 'GrailAccount','PipelineBucketType']]
+            cube = loaded_cube()
             startD, endD = input.date_range()
-            df_query = "timestamp >= @startD and timestamp < @endD"
-            fdf = df.query(df_query)
             category = 'PipelineBucketType'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf,
+            sizes = cube.category_sizes(category, (startD, endD))
+            cat_dict, cat_sizes = get_cat_sizes_dict(category, sizes,
                                                      session_cache)
-            choices = {k: v[0] for k, v in cat_dict.items()}
             selected = [k for k, v in cat_dict.items() if v[1]] or list(
                 cat_dict.keys())[:1]
+            choices, note = labels.limit_choices({k: v[0] for k, v in cat_dict.items()}, selected)
 
+            more_notes["pipeline_stage_group"].set(note)
             ui.update_checkbox_group(
                 "pipeline_stage_group",
                 choices=choices,
@@ -162,20 +249,20 @@ def create_server(df):
 
         @reactive.Effect
         def _a0b():
-            # df = df[['timestamp', 'Bytes', 'BucketName', 'StorageType','AWSAccount', 'GrailAccount','PipelineBucketType']]
+            cube = loaded_cube()
             pipeline_stage = input.pipeline_stage_group()
             with reactive.isolate():
                 startD, endD = input.date_range()
-            df_query =  "timestamp >= @startD and timestamp < @endD" + \
-                        f" and PipelineBucketType in @pipeline_stage"
-            fdf = df.query(df_query)
             category = 'GrailAccount'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf,
+            sizes = cube.category_sizes(category, (startD, endD),
+                                        PipelineBucketType=pipeline_stage)
+            cat_dict, cat_sizes = get_cat_sizes_dict(category, sizes,
                                                      session_cache)
-            choices = {k: v[0] for k, v in cat_dict.items()}
             selected = [k for k, v in cat_dict.items() if v[1]] or list(
                 cat_dict.keys())[:1]
+            choices, note = labels.limit_choices({k: v[0] for k, v in cat_dict.items()}, selected)
 
+            more_notes["grail_account_group"].set(note)
             ui.update_checkbox_group(
                 "grail_account_group",
                 choices=choices,
@@ -184,26 +271,26 @@ def create_server(df):
 
         @reactive.Effect
         def _a0c():
-            # df = df[['timestamp', 'Bytes', 'BucketName', 'StorageType','AWSAccount', 'GrailAccount','PipelineBucketType']]
+            cube = loaded_cube()
             grail_account = input.grail_account_group()
             pipeline_stage = input.pipeline_stage_group()
             bucket_name_filter = input.bucket_name_filter().strip()
             with reactive.isolate():
                 startD, endD = input.date_range()
 
-            df_query =  "timestamp >= @startD and timestamp < @endD" + \
-                        f" and GrailAccount in @grail_account" +\
-                        f" and PipelineBucketType in @pipeline_stage"
-            if bucket_name_filter != '':
-                df_query += f" and BucketName.str.contains(@bucket_name_filter)"
-            fdf = df.query(df_query)
             category = 'BucketName'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf,
+            sizes = cube.category_sizes(category, (startD, endD),
+                                        bucket_contains=bucket_name_filter,
+                                        GrailAccount=grail_account,
+                                        PipelineBucketType=pipeline_stage)
+            cat_dict, cat_sizes = get_cat_sizes_dict(category, sizes,
                                                      session_cache)
-            choices = {k: v[0] for k, v in cat_dict.items()}
             selected = [k for k, v in cat_dict.items() if v[1]] or list(
                 cat_dict.keys())[:1]
+            choices, note = labels.limit_choices({k: v[0] for k, v in cat_dict.items()}, selected,
+                                                 hint='narrow the list with Bucket Filter')
 
+            more_notes["bucket_group"].set(note)
             ui.update_checkbox_group(
                 "bucket_group",
                 choices=choices,
@@ -212,21 +299,21 @@ def create_server(df):
 
         @reactive.Effect
         def _a0d():
-            # df = df[['timestamp', 'Bytes', 'BucketName', 'StorageType','AWSAccount', 'GrailAccount','PipelineBucketType']]
+            cube = loaded_cube()
             bucket_list = input.bucket_group()
             with reactive.isolate():
                 startD, endD = input.date_range()
 
-            df_query = f"BucketName in @bucket_list " + \
-                        f" and timestamp >= @startD and timestamp < @endD"
-            fdf = df.query(df_query)
             category = 'StorageType'
-            cat_dict, cat_sizes = get_cat_sizes_dict(category, fdf,
+            sizes = cube.category_sizes(category, (startD, endD),
+                                        BucketName=bucket_list)
+            cat_dict, cat_sizes = get_cat_sizes_dict(category, sizes,
                                                      session_cache)
-            choices = {k: v[0] for k, v in cat_dict.items()}
             selected = [k for k, v in cat_dict.items() if v[1]] or list(
                 cat_dict.keys())[:1]
+            choices, note = labels.limit_choices({k: v[0] for k, v in cat_dict.items()}, selected)
 
+            more_notes["storage_tier_group"].set(note)
             ui.update_checkbox_group(
                 "storage_tier_group",
                 choices=choices,
@@ -236,6 +323,10 @@ def create_server(df):
         @output
         @render.text
         def txt():
+            if s3_cube() is None:
+                if s3_data['error']:
+                    return f"Loading S3 storage data failed ({s3_data['error']}), retrying ..."
+                return "Loading S3 storage data ..."
             grail_account = input.grail_account_group()
             pipeline_stage = input.pipeline_stage_group()
             bucket_name_filter = input.bucket_name_filter().strip()
@@ -250,8 +341,10 @@ def create_server(df):
 
         @output(id="out"
                 )  # decorator to link this function to the "out" id in the UI
-        @render.plot  # a decorator to indicate we want the plot renderer
+        @render.image(delete_file=True)
         def plot():
+            if input.client_chart(): return
+            cube = loaded_cube()
             grail_account = input.grail_account_group()
             pipeline_stage = input.pipeline_stage_group() 
             bucket_name_filter = input.bucket_name_filter().strip()
@@ -259,34 +352,96 @@ def create_server(df):
             with reactive.isolate():
                 startD, endD = input.date_range()
             bucket_list = input.bucket_group()
+            width, height, pixel_ratio = plot_cache.client_size(session, "out", PLOT_WIDTH,
+                                                                PLOT_HEIGHT)
+
+            def render_plot():
+                sub, fill = select_plot_rows(cube, startD, endD, grail_account,
+                                             pipeline_stage, storage_tiers,
+                                             bucket_list)
+                if sub.shape[0] == 0: return
+                if fill == 'BucketName':
+                  plot = create_plot(sub)  # create our plot
+                else:
+                  plot = create_bucket_plot(sub)
+                return plot_cache.figure_png(plot, width, height, pixel_ratio)
 
-            df_query = "timestamp >= @startD and timestamp < @endD " 
             if len(bucket_list) == 0:
-              df_query += " and GrailAccount in @grail_account" + \
-                  " and PipelineBucketType in @pipeline_stage"
-              if len(storage_tiers) > 0:
-                df_query += " and StorageType in @storage_tiers"
-              sub = df.query(df_query).copy()  # use it to create a subset
-              if sub.shape[0] == 0: return
-              plot = create_plot(sub)  # create our plot
-              return plot  # and return it
+              key = plot_cache.plot_key(s3_data['version'], "accounts", startD, endD, grail_account,
+                                        pipeline_stage, storage_tiers, width, height, pixel_ratio)
             else:
-              df_query = "BucketName in @bucket_list " + \
-                        " and timestamp >= @startD and timestamp < @endD"
-              if len(storage_tiers) > 0:
-                df_query += " and StorageType in @storage_tiers"
-              sub = df.query(df_query).copy()  # use it to create a subset
-              if sub.shape[0] == 0: return
-              plot = create_bucket_plot(sub)  # create our plot
-              return plot  # and return it
+              key = plot_cache.plot_key(s3_data['version'], "buckets", startD, endD, bucket_list,
+                                        storage_tiers, width, height, pixel_ratio)
+            png = plots.get(key, render_plot)
+            if png is None: return
+            return plot_cache.image_data(png, width, height)  # and return it
+
+        @output
+        @render.ui
+        def chart():
+            # same chart as plot, drawn by the browser from the aggregated rows
+            if not input.client_chart(): return
+            cube = loaded_cube()
+            grail_account = input.grail_account_group()
+            pipeline_stage = input.pipeline_stage_group()
+            storage_tiers = input.storage_tier_group()
+            with reactive.isolate():
+                startD, endD = input.date_range()
+            bucket_list = input.bucket_group()
+
+            sub, fill = select_plot_rows(cube, startD, endD, grail_account,
+                                         pipeline_stage, storage_tiers,
+                                         bucket_list)
+            if sub.shape[0] == 0: return
+            spec = chart_svc.stacked_bar_spec(get_plot_df(sub, fill),
+                                              x='timestamp', y='PetaBytes',
+                                              fill=fill, height=PLOT_HEIGHT - 100)
+            return chart_svc.chart_ui("s3_chart", spec)
 
     return f
 
 
-s3_df = data_svc.get_s3_df()
+# the data is loaded on a thread, the page is served (with placeholders)
+# before it is ready
+s3_data = {'cube': None, 'version': None, 'error': None}
+
+
+def load_s3_data():
+    # tries again until the data is loaded, the last failure is kept in
+    # s3_data['error'] for the sessions and /healthz
+    while True:
+        try:
+            start = time.time()
+            cube = data_svc.S3Cube(data_svc.get_s3_df())
+            s3_data.update(cube=cube, version=plot_cache.data_version(cube.df, 'Bytes'),
+                           error=None)
+            print(f'S3 data loaded in {time.time() - start:.1f}s')
+            return
+        except Exception as e:
+            s3_data['error'] = repr(e)
+            print(f'Loading S3 data failed: {e!r}')
+        time.sleep(S3_DATA_RETRY_SECS)
+
+
+threading.Thread(target=load_s3_data, name='s3-data-loader', daemon=True).start()
+
+frontend = create_ui()
+
+server = create_server(s3_data)
+
+app = App(frontend, server)
+
 
-frontend = create_ui(s3_df)
+def healthz(request):
+    # healthy as soon as the app serves pages, also while the data is loading,
+    # but not while loading it fails.
+    # The plot cache counters are reported here instead of logged per render.
+    if s3_data['cube'] is None and s3_data['error']:
+        return JSONResponse({'status': 'error', 'data': 'failed', 'error': s3_data['error']},
+                            status_code=503)
+    return JSONResponse({'status': 'ok',
+                         'data': 'loading' if s3_data['cube'] is None else 'ready',
+                         'plot_cache': plots.stats()})
 
-server = create_server(s3_df)
 
-app = App(frontend, server)
\ No newline at end of file
+app.starlette_app.router.routes.insert(0, Route('/healthz', healthz))
@@ -1,22 +1,134 @@
+import re
+
+import numpy as np
 import pandas as pd
 
+import common_path  # noqa: F401
+from metrics_io import read_account_csvs, period_start
+
+S3_CSV_DTYPES = {
+    'Bytes': 'float64',
+    'BucketName': 'category',
+    'StorageType': 'category',
+    'AWSAccount': 'category',
+    'GrailAccount': 'category',
+}
+
+
+# (pipeline stage, regex searched in the bucket name), the first matching rule
+# wins. archive is checked before sequ so sequencing archives are archives.
+PIPELINE_BUCKET_RULES = [
+    ('archive', r'archive'),
+    ('sequencing', r'sequ'),
+    ('results', r'results'),
+    ('fastq', r'fastq'),
+    ('working', r'working'),
+    ('cache', r'cache'),
+]
+PIPELINE_BUCKET_DEFAULT = 'non-pipeline'
+
+
+def pipeline_bucket_type(bucket_name, rules=PIPELINE_BUCKET_RULES, default=PIPELINE_BUCKET_DEFAULT):
+    for stage, pattern in rules:
+        if re.search(pattern, bucket_name):
+            return stage
+    return default
+
+
+def pipeline_bucket_types(bucket_names, rules=PIPELINE_BUCKET_RULES, default=PIPELINE_BUCKET_DEFAULT):
+    # pipeline_bucket_type for a column of bucket names, the rules run once per
+    # distinct name and the rows get the result through the category codes
+    bucket_names = bucket_names.astype('category')
+    stages = [pipeline_bucket_type(name, rules, default) for name in bucket_names.cat.categories]
+    stage_categories = pd.Index(sorted(set(stages)))
+    # code -1 (missing bucket name) stays missing
+    remap = np.append(stage_categories.get_indexer(stages), -1)
+    return pd.Series(pd.Categorical.from_codes(remap[bucket_names.cat.codes.values], categories=stage_categories),
+                     index=bucket_names.index)
+
 
-def pipeline_bucket_type(bucket_name):
-    return "sequencing" if ('sequ' in bucket_name and 'archive' not in bucket_name) else \
-        "archive" if ('archive' in bucket_name) else \
-        "results" if ('results' in bucket_name) else \
-        "fastq" if ('fastq' in bucket_name) else\
-        "working"  if ('working' in bucket_name) else\
-        "cache" if ('cache' in bucket_name) else "non-pipeline"
 def get_s3_df():
-    BASE_PATH='/Users/avashisth/workspace/aws-util/cost-explorer/data'
-    gaccts = ['clinical', 'grail-sysinfra-eng', 'eng', 'grail-sysinfra-prod', 'grail-prod-galleri', 'msk',
-            'aws-grail-sequence-data-archives', 'grail-prod-mrd']
-    df = pd.concat([
-        pd.read_csv(f'{BASE_PATH}/metrics/{account}/s3-storage-metrics.csv.gz')
-        for account in gaccts
-    ]).reset_index()
-    df['timestamp'] = pd.to_datetime(df['Timestamp'])
-    df['PipelineBucketType'] = df['BucketName'].apply(pipeline_bucket_type)
+    df = read_account_csvs('s3-storage-metrics.csv.gz', S3_CSV_DTYPES, parse_dates=['Timestamp'])
+    df = df.rename(columns={'Timestamp': 'timestamp'})
+    df['PipelineBucketType'] = pipeline_bucket_types(df['BucketName'])
     df = df[['timestamp', 'Bytes', 'BucketName', 'StorageType','AWSAccount', 'GrailAccount','PipelineBucketType']]
-    return df
\ No newline at end of file
+    return df
+
+
+# dimensions of the daily storage cube, AWSAccount is not used by the explorer
+S3_CUBE_DIMENSIONS = ['BucketName', 'StorageType', 'GrailAccount', 'PipelineBucketType']
+
+
+class S3Cube:
+    # Daily bytes per (timestamp, bucket, storage type, account, stage), built
+    # once from the loaded metrics. The dimensions are categoricals and filters
+    # compare their integer codes. Rows are sorted by timestamp, so a date range
+    # is a binary search.
+
+    def __init__(self, df: pd.DataFrame):
+        df = df[['timestamp'] + S3_CUBE_DIMENSIONS + ['Bytes']] \
+            .astype({column: 'category' for column in S3_CUBE_DIMENSIONS})
+        self.df = df.groupby(by=['timestamp'] + S3_CUBE_DIMENSIONS, observed=True, sort=True) \
+            .sum().reset_index()
+        self.timestamps = self.df['timestamp'].values
+        self.codes = {column: self.df[column].cat.codes.values for column in S3_CUBE_DIMENSIONS}
+        self.categories = {column: self.df[column].cat.categories for column in S3_CUBE_DIMENSIONS}
+
+    def date_bounds(self, startD, endD):
+        bounds = pd.DatetimeIndex([startD, endD]).values.astype(self.timestamps.dtype)
+        return np.searchsorted(self.timestamps, bounds)
+
+    def filter(self, date_range, bucket_contains=None, **filters):
+        # positions of rows with startD <= timestamp < endD, a value in the given
+        # list for every dimension passed as a keyword (None for all) and, with
+        # bucket_contains, a bucket name matching that regex
+        lo, hi = self.date_bounds(*date_range)
+        selected = np.ones(hi - lo, dtype=bool)
+        for column, values in filters.items():
+            if values is None:
+                continue
+            codes = self.categories[column].get_indexer(list(values))
+            selected &= np.isin(self.codes[column][lo:hi], codes[codes >= 0])
+        if bucket_contains:
+            buckets = self.categories['BucketName']
+            codes = np.flatnonzero(buckets.str.contains(bucket_contains))
+            selected &= np.isin(self.codes['BucketName'][lo:hi], codes)
+        return np.flatnonzero(selected) + lo
+
+    def slice(self, date_range, bucket_contains=None, **filters):
+        return self.df.iloc[self.filter(date_range, bucket_contains, **filters)]
+
+    def slice_at(self, resolution, date_range, bucket_contains=None, **filters):
+        # slice() per day, week or month. Storage is a level, not a flow, so a
+        # week / month row holds the mean daily bytes over the days of the
+        # period inside date_range that have data.
+        rows = self.slice(date_range, bucket_contains, **filters)
+        if resolution == 'day':
+            return rows
+        lo, hi = self.date_bounds(*date_range)
+        days = pd.Series(np.unique(self.timestamps[lo:hi]))
+        days_per_period = days.groupby(period_start(days, resolution)).size()
+        starts = pd.Series(period_start(rows['timestamp'], resolution), index=rows.index)
+        return rows.assign(timestamp=starts, Bytes=rows['Bytes'] / starts.map(days_per_period)) \
+            .groupby(by=['timestamp'] + S3_CUBE_DIMENSIONS, observed=True, sort=True) \
+            .sum().reset_index()
+
+    def category_sizes(self, category, date_range, bucket_contains=None, **filters):
+        # mean daily bytes per value of category over the days it has data,
+        # largest first
+        positions = self.filter(date_range, bucket_contains, **filters)
+        if len(positions) == 0:
+            return pd.Series([], index=self.categories[category][:0].rename(category),
+                             dtype='float64', name='Bytes')
+        days, day_codes = np.unique(self.timestamps[positions], return_inverse=True)
+        keys = self.codes[category][positions].astype(np.int64) * len(days) + day_codes
+        size = len(self.categories[category]) * len(days)
+        totals = np.bincount(keys, weights=self.df['Bytes'].values[positions], minlength=size)
+        present = np.bincount(keys, minlength=size) > 0
+        totals = totals.reshape(-1, len(days)).sum(axis=1)
+        day_counts = present.reshape(-1, len(days)).sum(axis=1)
+        has_data = day_counts > 0
+        sizes = pd.Series(totals[has_data] / day_counts[has_data],
+                          index=self.categories[category][has_data].rename(category),
+                          name='Bytes')
+        return sizes.sort_values(ascending=False)